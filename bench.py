@@ -0,0 +1,251 @@
+#!/usr/bin/python
+
+# Benchmarks for the normalizer. Run "python bench.py" to time parse end to end
+# and by phase on generated data, along with the search helpers and
+# peak memory. Use --save to store the timings as a baseline, and later runs
+# will report the change against it. --parallel times parse_parallel with an
+# increasing number of worker processes instead.
+
+import argparse
+import copy
+import json
+import multiprocessing
+import os
+import random
+import sys
+import time
+from norm import Normalize, NormalizeBatch
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+    import resource
+
+def generate(count, depth=2, fanout=2, list_ratio=0.5, repeat=0.2, seed=1):
+    '''generate nested records with depth levels of nested entities
+
+    Each level is stored under the key "key<level>" and holds either a single
+    entity or, with a probability of list_ratio, a list of up to fanout of them.
+    With a probability of repeat an entity is a copy of one generated earlier.
+    '''
+
+    rand = random.Random(seed)
+    made = [[] for v in range(depth + 1)]
+
+    def entity(level, entity_id):
+        row = {'id': entity_id, 'name': 'entity %d' % entity_id, 'score': rand.random(),
+            'tags': ['tag%d' % rand.randint(0, 9) for v in range(3)], 'meta': {'level': level}}
+        if level < depth:
+            row['key%d' % (level + 1)] = nested(level + 1)
+        return row
+
+    def nested(level):
+        if rand.random() < list_ratio:
+            return [child(level) for v in range(rand.randint(1, fanout))]
+        return child(level)
+
+    def child(level):
+        if made[level] and rand.random() < repeat:
+            return copy.deepcopy(rand.choice(made[level]))
+        row = entity(level, len(made[level]) + 1)
+        made[level].append(copy.deepcopy(row))
+        return row
+
+    return [entity(0, i) for i in range(1, count + 1)]
+
+def chain(depth):
+    '''generate a single record nested depth levels deep, alternating dicts and lists'''
+
+    data = row = {'id': 0}
+    for level in range(1, depth + 1):
+        child = {'id': level, 'name': 'entity %d' % level}
+        row['child'] = [child] if level % 2 else child
+        row = child
+    row['bottom'] = {'id': depth + 1}
+    return data
+
+def schema(depth=2, new_keys=True):
+    '''build a normalizer for generated data'''
+
+    norm = Normalize()
+    norm.define_primary('level0')
+    for level in range(1, depth + 1):
+        norm.define_nested_entity('level%d' % level, 'key%d' % level)
+    if new_keys and depth:
+        norm.add_one_to_many_key('parent_ids', 'key1', 'level1', 'level0')
+    return norm
+
+def timed(func, *args):
+    '''return the time and result of a single call'''
+
+    start = time.time()
+    res = func(*args)
+    return time.time() - start, res
+
+def _peak_rss(func, args, out):
+    '''report the growth in peak resident memory during a call'''
+
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    func(*args)
+    out.put((resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before) * 1024)
+
+def peak_memory(func, *args):
+    '''return the peak memory in bytes allocated during a call'''
+
+    if tracemalloc:
+        tracemalloc.start()
+        func(*args)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return peak
+    # without tracemalloc, call in a forked process whose peak starts at its current size
+    out = multiprocessing.Queue()
+    proc = multiprocessing.Process(target=_peak_rss, args=(func, args, out))
+    proc.start()
+    peak = out.get()
+    proc.join()
+    return peak
+
+def bench_phases(data, depth):
+    '''time each phase of a parse, following the steps parse takes'''
+
+    norm = schema(depth)
+    norm.swap_primary('level1' if depth else 'level0')
+    res = {}
+    name, id_key, new_data = norm._base_data()
+    res['field_changes'] = timed(norm._set_projections, name)[0]
+    res['order'], keys = timed(norm._entity_keys, name)
+    start = time.time()
+    for entry in data:
+        norm._parse_entry(name, id_key, keys, entry, new_data)
+    res['extract'] = time.time() - start
+    res['primary_swap'], new_data = timed(norm._process_primary_swap, new_data)
+    res['new_keys'] = timed(norm._process_new_keys, new_data)[0]
+    return res
+
+def bench_helpers(data, depth):
+    '''time the search helpers over every record and on a single deeply nested one'''
+
+    norm = schema(depth)
+    key = 'key%d' % depth
+    res = {}
+    res['search_dict_all'] = timed(lambda: [norm._search_dict_all(v, key) for v in data])[0]
+    res['get_entity_depth'] = timed(lambda: [norm._get_entity_depth(key, v) for v in data])[0]
+    res['set_nested_id'] = timed(lambda: [norm._set_nested_id(v, key, 0) for v in data])[0]
+    deep = chain(sys.getrecursionlimit() * 10)
+    res['search_dict_all_deep'] = timed(norm._search_dict_all, deep, 'bottom')[0]
+    res['get_entity_depth_deep'] = timed(norm._get_entity_depth, 'bottom', deep)[0]
+    res['set_nested_id_deep'] = timed(norm._set_nested_id, deep, 'bottom', 0)[0]
+    norm = Normalize()
+    norm.define_primary('chain')
+    norm.define_nested_entity('bottom', 'bottom')
+    res['parse_deep'] = timed(norm.parse, [chain(sys.getrecursionlimit() * 10)])[0]
+    return res
+
+def best(runs, func, data, *args):
+    '''return the fastest of several calls, each on a fresh copy of the data'''
+
+    return min(timed(func, copy.deepcopy(data), *args)[0] for v in range(runs))
+
+def bench(args):
+    '''run the parse benchmarks, returning a dict of timings and memory'''
+
+    data = generate(args.count, args.depth, args.fanout, args.list_ratio, args.repeat, args.seed)
+    res = {}
+    res['peak_memory_mb'] = peak_memory(schema(args.depth).parse, copy.deepcopy(data)) / 1048576.0
+    res['parse'] = best(args.runs, lambda v: schema(args.depth).parse(v), data)
+    norm = schema(args.depth)
+    norm.set_preserve_input()
+    res['parse_preserve'] = min(timed(norm.parse, data)[0] for v in range(args.runs))
+    plan = schema(args.depth).compile()
+    res['parse_compiled'] = best(args.runs, plan.parse, data)
+    norm = schema(args.depth)
+    norm.set_dedupe()
+    res['parse_dedupe'] = best(args.runs, norm.parse, data)
+    norm = schema(args.depth)
+    for level in range(1, args.depth + 1):
+        norm.keep_flds('level%d' % level, 'name')
+        norm.keep_flds('level%d' % level, 'key%d' % (level + 1))
+    res['parse_projected'] = best(args.runs, norm.parse, data)
+    norm = schema(args.depth, new_keys=False)
+    norm.set_relations()
+    res['parse_relations'] = best(args.runs, norm.parse, data)
+    batch = NormalizeBatch()
+    batch.add_primary(schema(args.depth, new_keys=False), 'first')
+    batch.add_primary(schema(args.depth, new_keys=False), 'second')
+    half = len(data) // 2
+    res['parse_batch'] = best(args.runs, batch.parse, {'first': data[:half], 'second': data[half:]})
+    norm = schema(args.depth, new_keys=False)
+    parsed = norm.parse(copy.deepcopy(data))
+    res['denormalize'] = min(timed(norm.denormalize, parsed)[0] for v in range(args.runs))
+    for i in range(args.runs):
+        for name, elapsed in bench_phases(copy.deepcopy(data), args.depth).items():
+            res['phase.' + name] = min(res.get('phase.' + name, elapsed), elapsed)
+        for name, elapsed in bench_helpers(copy.deepcopy(data), args.depth).items():
+            res['helper.' + name] = min(res.get('helper.' + name, elapsed), elapsed)
+    return res
+
+def bench_parallel(args):
+    '''compare a serial parse with parse_parallel at each worker count'''
+
+    data = generate(args.count, args.depth, args.fanout, args.list_ratio, args.repeat, args.seed)
+    res = {'parse': best(args.runs, lambda v: schema(args.depth).parse(v), data)}
+    workers = args.workers or multiprocessing.cpu_count()
+    count = 1
+    while count <= workers:
+        res['parse_parallel.%d' % count] = best(args.runs,
+            lambda v: schema(args.depth).parse_parallel(v, count), data)
+        count *= 2
+    return res
+
+def report(res, baseline, tolerance):
+    '''print the results against the baseline, returning the names of any regressions'''
+
+    slower = []
+    for name in sorted(res):
+        line = '%-28s %10.4f' % (name, res[name])
+        if name in baseline and baseline[name]:
+            change = res[name] / baseline[name]
+            line += ' %8.2fx' % change
+            if change > 1 + tolerance and res[name] - baseline[name] > 0.001:
+                line += '  regression'
+                slower.append(name)
+        print(line)
+    return slower
+
+def main(argv=None):
+    '''command line entry point'''
+
+    parser = argparse.ArgumentParser(description='Benchmark the normalizer on generated data')
+    parser.add_argument('--count', type=int, default=20000, help='primary records')
+    parser.add_argument('--depth', type=int, default=3, help='levels of nested entities')
+    parser.add_argument('--fanout', type=int, default=3, help='max entities in a nested list')
+    parser.add_argument('--list-ratio', type=float, default=0.5,
+        help='share of nested values that are lists rather than dicts')
+    parser.add_argument('--repeat', type=float, default=0.2,
+        help='share of nested entities that repeat an earlier one')
+    parser.add_argument('--seed', type=int, default=1, help='random seed')
+    parser.add_argument('--runs', type=int, default=3, help='runs to take the fastest of')
+    parser.add_argument('--parallel', action='store_true', help='benchmark parse_parallel')
+    parser.add_argument('--workers', type=int, default=None, help='max parallel workers')
+    parser.add_argument('--baseline', default='bench_baseline.json', help='baseline file')
+    parser.add_argument('--save', action='store_true', help='save the results as the baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+        help='slowdown against the baseline reported as a regression')
+    args = parser.parse_args(argv)
+
+    res = bench_parallel(args) if args.parallel else bench(args)
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as fp:
+            baseline = json.load(fp)
+    slower = report(res, baseline, args.tolerance)
+    if args.save:
+        baseline.update(res)
+        with open(args.baseline, 'w') as fp:
+            json.dump(baseline, fp, indent=2, sort_keys=True)
+    return 1 if slower and not args.save else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -40,6 +40,12 @@ if __name__ == '__main__':
     norm.define_nested_entity('users', 'author')
     norm.define_nested_entity('addresses', 'address')
 
+    # entities can instead be defined by a dotted path of keys from the primary entity,
+    # where '*' matches any key. Only those paths are walked and the rest of each entry
+    # is left untouched, which is much faster for entries with large unrelated subtrees.
+    # Entities defined by path and by key can not be mixed, raising a ValueError.
+    #norm.define_nested_path('users', 'author')
+    #norm.define_nested_path('addresses', 'author.address')
 
     # rename fields for a given entity name
     # norm.rename_flds('addresses', 'street', 'road')
@@ -47,12 +53,17 @@ if __name__ == '__main__':
     # remove fields for a given entity name
     # norm.remove_flds('addresses', 'city')
 
-    # entities nested multiple times require the depth to be defined so there is no
-    # data loss. If not set, the code will dynamically determine the depth, but only
-    # by using the first entry in the data set. If it's missing an entity it won't
-    # parse correctly. If your data set is all structured the same (no rows are missing
-    # an entity), you can skip this step. Otherwise, entities should be listed in order
-    # of the most deeply nested to the least.
+    # or keep only the given fields for an entity name, along with its id field.
+    # Field changes are applied to every entity as it is extracted. Removed fields
+    # are dropped before the rest of the entity is searched, so large unused fields
+    # cost nothing, unless they are entity keys, which are dropped once the entities
+    # in them are extracted. Fields are renamed once the nested entities are replaced.
+    # norm.keep_flds('addresses', 'street')
+
+    # each entry is walked once and nested entities are replaced with ids on the way
+    # back up, so rows that are missing an entity parse correctly and the order of the
+    # entities does not matter. Setting an entity order limits flattening to the
+    # entities listed in it, and every defined entity is flattened if it is not set.
     #norm.set_entity_order(('addresses', 'users'))
 
     # you can swap the primary entity in the data set with a nested entity by setting
@@ -67,6 +78,108 @@ if __name__ == '__main__':
     # and the forth argument is the entity to pull the keys from.
     #norm.add_one_to_many_key('user_ids', 'address', 'addresses', 'users')
 
+    # parsing replaces nested data with ids in place. To leave the data untouched,
+    # for example when it is cached, enable preserve input and only the rows that
+    # change will be copied. This is much faster than a deepcopy of the data.
+    #norm.set_preserve_input()
+
+    # when the same entity appears many times, dedupe keeps the first copy of each
+    # id. With 'trust', later copies are replaced with the id without being searched,
+    # 'compare' raises a ValueError if a later copy differs, and 'merge' merges later
+    # copies into the first one.
+    #norm.set_dedupe('trust')
+
+    # large entity tables can be returned in a compact columnar layout. Each table is
+    # a ColumnTable with an id index and one column per field, stored in a typed array
+    # when it only holds ints or floats. Rows are still read with table[id][field],
+    # missing values read as None, and table.column(field) returns a whole column.
+    #norm.set_columnar()
+
+    # when only some of the tables are read, enable lazy to have parse return a
+    # NormalizedResult. It is read like the usual result, but each table is only
+    # built when first read, flattening just the rows of that entity along with its
+    # one to many keys and columnar layout. The first nested table read walks the
+    # data once to find the rows of every entity, and the primary table and results
+    # need no walk unless the primary is swapped. Reading every table costs more than
+    # a plain parse, unless they are all built at once with to_dict. The input is
+    # always preserved, and missing primary ids raise at parse, but errors in nested
+    # entities are only raised when a table is read. Statistics and relations are not
+    # supported when lazy, raising a ValueError.
+    #norm.set_lazy()
+
+    # to keep entity tables between calls, wrap the normalizer in a NormalizedStore.
+    # Each merge normalizes only the new batch, upserts it into the stored tables and
+    # one to many keys, and returns the delta of added, changed and removed ids along
+    # with the new rows. Ids to remove can be passed as a dict of entity to ids.
+    #from norm import NormalizedStore
+    #store = NormalizedStore(norm)
+    #delta = store.merge(data)
+    #delta = store.merge([], {'articles': [4]})
+
+    # when an endpoint returns several collections together, such as articles and
+    # comments, add a configured normalizer for each to a NormalizeBatch. Its parse
+    # takes a dict of collections, keyed by the primary name or the collection passed
+    # to add_primary, and flattens every collection straight into one shared set of
+    # entity tables, so a user found in both is stored once. Results holds the ids of
+    # each collection, or the ids found in that collection when its primary is swapped.
+    # An entity used by several primaries must have the same id field.
+    #from norm import NormalizeBatch
+    #batch = NormalizeBatch()
+    #batch.add_primary(norm)
+    #batch.add_primary(comments, 'feedback')
+    #pprint.pprint(batch.parse({'articles': data, 'feedback': comment_data}))
+
+    # to look up how entities are related, enable relations. Each parse then records
+    # in norm.relations the row each entity was found in and the primary record
+    # holding it. relations.parents('addresses', 1, 'users') returns the ids of the
+    # users holding address 1, children gives the reverse, and records returns the
+    # primary ids. Relations are not recorded by parse_parallel.
+    #norm.set_relations()
+
+    # to see where a parse spends its time, enable statistics. After each parse,
+    # norm.stats holds the nodes visited, the deepest nesting reached, the rows
+    # extracted, overwritten and skipped per entity, and the time spent in each phase.
+    # Hooks added with add_stats_hook are called with the statistics after each parse.
+    # Statistics are not collected by parse_parallel, parse_iter or NormalizedStore,
+    # which raise a ValueError.
+    #norm.set_stats()
+    #norm.add_stats_hook(pprint.pprint)
+
+    # once the settings are final, compile them into an immutable NormalizePlan. A
+    # plan has its own parse and parse_iter methods, keeps no state between calls
+    # and can be shared by any number of threads.
+    #plan = norm.compile()
+    #pprint.pprint(plan.parse(data))
+
+    # large or streamed data sets can be normalized in chunks by passing any iterable
+    # to parse_iter, which yields a result for every chunk_size entries. Entities are
+    # only included in the first chunk they appear in. One to many keys are not
+    # supported in this mode.
+    #for chunk in norm.parse_iter(iter(data), chunk_size=2):
+    #    pprint.pprint(chunk)
+
+    # on Python 3, pages from an async iterator, such as a paginated API client, can
+    # be normalized with parse_pages while the next page is fetched. The result is
+    # the same as parsing all the pages at once. Pass an executor to normalize each
+    # page in a thread, keeping the event loop responsive. Relations are recorded as
+    # in parse, but statistics are not supported, raising a ValueError.
+    #from norm_async import parse_pages
+    #result = await parse_pages(norm, client.pages(), executor=ThreadPoolExecutor(1))
+
+    # normalized data can be turned back into nested records with denormalize, which
+    # reverses renamed fields and nests entities up to depth levels deep, or fully if
+    # depth is not set. Each rebuilt entity is shared by every record that refers to
+    # it, so copy a record before changing it. With lazy, records are LazyRow objects
+    # that only look up nested entities when a field is read.
+    #records = norm.denormalize(norm.parse(data), depth=2)
+    #records = norm.denormalize(norm.parse(data), lazy=True)
+
+    # to send a large result to a file or socket, write_json encodes it a chunk of
+    # rows at a time instead of building the whole string with json.dumps. The output
+    # is the same, including ids that are not strings.
+    #from norm import write_json
+    #write_json(norm.parse(data), sys.stdout)
+
     # normalize and return the data
     pprint.pprint(norm.parse(data))
 
@@ -5,6 +5,604 @@
 # values to define the output keys and any entities that you want to flatten.
 # Nested data that is not defined to be flattened will be left in place
 
+import argparse
+import array
+import itertools
+import json
+import multiprocessing
+import re
+import sys
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+try:
+    _STRING_TYPES = (str, unicode)
+except NameError:
+    _STRING_TYPES = (str,)
+
+CONFLICT_POLICIES = ('first', 'last', 'merge')
+DEDUPE_POLICIES = ('trust', 'compare', 'merge')
+STATS_PHASES = ('order', 'field_changes', 'primary_swap', 'new_keys', 'columns')
+
+try:
+    _INT_CODE = array.array('q').typecode
+except ValueError:
+    _INT_CODE = 'l'
+_INT_MAX = 2 ** (array.array(_INT_CODE).itemsize * 8 - 1) - 1
+
+def _is_leaf(value):
+    '''check if a dict or list holds no nested dicts or lists'''
+
+    for v in (value if isinstance(value, list) else value.values()):
+        if isinstance(v, (dict, list)):
+            return False
+    return True
+
+class ColumnTable(object):
+    '''an entity table stored as an id index plus one column per field'''
+
+    def __init__(self, rows):
+        '''build the columns from a dict of rows keyed on id'''
+
+        self.ids = list(rows)
+        self.index = dict((v, i) for i, v in enumerate(self.ids))
+        self.columns = {}
+        for pos, entity_id in enumerate(self.ids):
+            row = rows[entity_id]
+            for fld in row:
+                if fld not in self.columns:
+                    self.columns[fld] = [None] * len(self.ids)
+                self.columns[fld][pos] = row[fld]
+        for fld in self.columns:
+            self.columns[fld] = self._compact(self.columns[fld])
+
+    def _compact(self, values):
+        '''store a column of only ints or only floats in a typed array'''
+
+        types = set(type(v) for v in values if v is not None)
+        if types == set([float]):
+            code = 'd'
+        elif types and types <= set([int, type(_INT_MAX + 1)]) and all(v is None or
+                -_INT_MAX - 1 <= v <= _INT_MAX for v in values):
+            code = _INT_CODE
+        else:
+            return values
+        if None not in values:
+            return array.array(code, values)
+        column = array.array(code, [0 if v is None else v for v in values])
+        return (column, bytearray(v is not None for v in values))
+
+    def column(self, fld):
+        '''return the values of a field in id order, with None for missing values'''
+
+        column = self.columns[fld]
+        if isinstance(column, tuple):
+            return [v if present else None for v, present in zip(*column)]
+        return list(column)
+
+    def value(self, pos, fld):
+        '''return a single value, or None if it is missing'''
+
+        column = self.columns[fld]
+        if isinstance(column, tuple):
+            return column[0][pos] if column[1][pos] else None
+        return column[pos]
+
+    def __getitem__(self, entity_id):
+        return RowView(self, self.index[entity_id])
+
+    def __contains__(self, entity_id):
+        return entity_id in self.index
+
+    def __iter__(self):
+        return iter(self.ids)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def keys(self):
+        return list(self.ids)
+
+    def to_dict(self):
+        '''convert back into a dict of rows keyed on id'''
+
+        return dict((v, self[v].to_dict()) for v in self.ids)
+
+class RowView(object):
+    '''a lazy, read only view of one row of a ColumnTable'''
+
+    __slots__ = ('table', 'pos')
+
+    def __init__(self, table, pos):
+        self.table = table
+        self.pos = pos
+
+    def __getitem__(self, fld):
+        return self.table.value(self.pos, fld)
+
+    def get(self, fld, default=None):
+        if fld not in self.table.columns:
+            return default
+        return self.table.value(self.pos, fld)
+
+    def __contains__(self, fld):
+        return fld in self.table.columns and self.table.value(self.pos, fld) is not None
+
+    def keys(self):
+        return [v for v in self.table.columns if self.table.value(self.pos, v) is not None]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __eq__(self, other):
+        return self.to_dict() == (other.to_dict() if isinstance(other, RowView) else other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def to_dict(self):
+        '''convert the row into a dict, leaving out missing values'''
+
+        return dict((v, self.table.value(self.pos, v)) for v in self.keys())
+
+class LazyRow(object):
+    '''a denormalized row that rebuilds nested entities only when a field is read'''
+
+    __slots__ = ('rebuild', 'row', 'depth', 'keys_at', 'cache')
+
+    def __init__(self, rebuild, row, depth, keys_at):
+        self.rebuild = rebuild
+        self.row = row
+        self.depth = depth
+        self.keys_at = keys_at
+        self.cache = {}
+
+    def __getitem__(self, fld):
+        if fld not in self.cache:
+            self.cache[fld] = self.rebuild.lazy_value(fld, self.row[fld], self.depth,
+                self.keys_at)
+        return self.cache[fld]
+
+    def get(self, fld, default=None):
+        if fld not in self.row:
+            return default
+        return self[fld]
+
+    def __contains__(self, fld):
+        return fld in self.row
+
+    def keys(self):
+        return list(self.row)
+
+    def __iter__(self):
+        return iter(self.row)
+
+    def __len__(self):
+        return len(self.row)
+
+    def __eq__(self, other):
+        return self.to_dict() == (other.to_dict() if isinstance(other, LazyRow) else other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def to_dict(self):
+        '''rebuild the whole row at once'''
+
+        return self.rebuild.nested(dict(self.row), self.depth, self.keys_at)
+
+class _Denormalizer(object):
+    '''rebuild nested entities from entity tables, memoizing each by entity, id and depth'''
+
+    def __init__(self, norm, entities):
+        self.tables = entities
+        # the entity fields are found the same way _extract finds them, so entities defined
+        # by path are told apart by where they are held and not just by their last key
+        self.keys = norm._entity_keys(norm._primary_name())
+        self.paths = isinstance(self.keys, _EntityPath)
+        self.ignore = norm.ignore_flds
+        self.renames = norm.rename_fldvals
+        self.memo = {}
+        self.lazy_memo = {}
+        self.building = []
+        self.tainted = sys.maxsize
+
+    def lookup(self, entity, entity_id):
+        '''copy an entity row, reversing its renamed fields'''
+
+        row = self.tables[entity][entity_id]
+        row = row.to_dict() if isinstance(row, RowView) else dict(row)
+        for name, new_name in reversed(self.renames.get(entity, ())):
+            if new_name in row and name not in row:
+                row[name] = row.pop(new_name)
+        return row
+
+    def entity_keys(self, entity):
+        '''return the keys to search the rows of an entity with'''
+
+        if not self.paths:
+            return self.keys
+        stack = [self.keys]
+        while stack:
+            node = stack.pop()
+            if node.entity == entity:
+                return node
+            stack.extend(node.children.values())
+        return self.keys
+
+    def field(self, keys, fld):
+        '''return the entity held in a field, or None, and the keys to search its value
+        with, or None if it is not searched'''
+
+        if self.paths:
+            node = keys.children.get(fld) or keys.children.get('*')
+            if node is None:
+                return None, None
+            return node.entity, node
+        if fld in keys:
+            return keys[fld][0], keys
+        if fld in self.ignore:
+            return None, None
+        return None, keys
+
+    def ids(self, entity, value, depth):
+        '''return the entity ids held in a value if they should be rebuilt, or None'''
+
+        if depth == 0 or entity is None or not isinstance(value, list):
+            return None
+        table = self.tables.get(entity, {})
+        for entity_id in value:
+            if isinstance(entity_id, (dict, list)) or entity_id not in table:
+                return None
+        return value
+
+    def entity(self, entity, entity_id, depth, keys):
+        '''rebuild an entity, leaving its id in place of a reference back to itself'''
+
+        memo_key = (entity, entity_id, depth, id(keys))
+        if memo_key in self.memo:
+            return self.memo[memo_key]
+        if (entity, entity_id) in self.building:
+            # the entities in the cycle depend on where it was entered, so are not memoized
+            self.tainted = min(self.tainted, self.building.index((entity, entity_id)))
+            return entity_id
+        self.building.append((entity, entity_id))
+        try:
+            row = self.nested(self.lookup(entity, entity_id), depth, keys)
+        finally:
+            self.building.pop()
+        if len(self.building) < self.tainted:
+            self.memo[memo_key] = row
+        if len(self.building) <= self.tainted:
+            self.tainted = sys.maxsize
+        return row
+
+    def nested(self, row, depth, keys):
+        '''replace the entity ids held anywhere in a copied row with rebuilt entities'''
+
+        for fld in row:
+            entity, child = self.field(keys, fld)
+            if child is None:
+                continue
+            value = row[fld]
+            ids = self.ids(entity, value, depth)
+            if ids is not None:
+                row[fld] = [self.entity(entity, v, None if depth is None else depth - 1,
+                    child) for v in ids]
+            elif isinstance(value, dict):
+                row[fld] = self.nested(dict(value), depth, child)
+            elif isinstance(value, list):
+                row[fld] = [self.nested(dict(v), depth, child) if isinstance(v, dict) else v
+                    for v in value]
+        return row
+
+    def lazy_entity(self, entity, entity_id, depth, keys):
+        '''return the LazyRow of an entity, shared by every reference to it'''
+
+        memo_key = (entity, entity_id, depth, id(keys))
+        if memo_key not in self.lazy_memo:
+            self.lazy_memo[memo_key] = LazyRow(self, self.lookup(entity, entity_id), depth,
+                keys)
+        return self.lazy_memo[memo_key]
+
+    def lazy_value(self, fld, value, depth, keys):
+        '''resolve a field of a LazyRow'''
+
+        entity, child = self.field(keys, fld)
+        if child is None:
+            return value
+        ids = self.ids(entity, value, depth)
+        if ids is not None:
+            return [self.lazy_entity(entity, v, None if depth is None else depth - 1, child)
+                for v in ids]
+        if isinstance(value, dict):
+            return LazyRow(self, value, depth, child)
+        if isinstance(value, list):
+            return [LazyRow(self, v, depth, child) if isinstance(v, dict) else v
+                for v in value]
+        return value
+
+class RelationIndex(object):
+    '''links between entities, recorded as each entity is replaced by its id'''
+
+    def __init__(self, primary):
+        self.primary = primary
+        self.path = []
+        self.parent_links = {}
+        self.child_links = {}
+        self.record_links = {}
+
+    def link(self, entity, entity_id, skipped=False):
+        '''link an entity to the row it was found in and the primary record holding it. If
+        the entity was skipped as a known copy, the entities found in it are linked to the
+        record as well'''
+
+        parent = self.path[-1]
+        child = (entity, entity_id)
+        record = self.path[0][1]
+        self.parent_links.setdefault(child, set()).add(parent)
+        self.child_links.setdefault(parent, set()).add(child)
+        self.record_links.setdefault(child, set()).add(record)
+        if skipped:
+            seen = set([child])
+            stack = list(self.child_links.get(child, ()))
+            while stack:
+                child = stack.pop()
+                if child not in seen:
+                    seen.add(child)
+                    self.record_links.setdefault(child, set()).add(record)
+                    stack.extend(self.child_links.get(child, ()))
+
+    def parents(self, entity, entity_id, parent_entity=None):
+        '''return the (entity, id) pairs an entity was found in, or only the ids of parent_entity'''
+
+        links = self.parent_links.get((entity, entity_id), ())
+        if parent_entity is None:
+            return list(links)
+        return [v[1] for v in links if v[0] == parent_entity]
+
+    def children(self, entity, entity_id, child_entity=None):
+        '''return the (entity, id) pairs found in an entity, or only the ids of child_entity'''
+
+        links = self.child_links.get((entity, entity_id), ())
+        if child_entity is None:
+            return list(links)
+        return [v[1] for v in links if v[0] == child_entity]
+
+    def records(self, entity, entity_id):
+        '''return the ids of the primary records an entity was found in'''
+
+        return list(self.record_links.get((entity, entity_id), ()))
+
+class NormalizedResult(object):
+    '''a parse result that flattens the rows of each entity only when its table is first read'''
+
+    def __init__(self, norm, data):
+        '''keep a copy of the list of entries, checking each has an id'''
+
+        self.norm = norm
+        self.data = list(data)
+        name = norm._primary_name()
+        self.names = [name] + list(norm.entities[name]['entities'])
+        self.index = None
+        self.rows = {}
+        self.indexes = None
+        self.tables = {}
+        id_key = norm.entities[name]['id']
+        for entry in self.data:
+            if id_key not in entry:
+                raise ValueError('Id key "%s" missing from data' % id_key)
+        self.ids = None if norm.swap_primary_to else [v[id_key] for v in self.data]
+
+    def _entity_rows(self, name):
+        '''flatten the rows of one entity on first use, without any post processing
+
+        The rows of every nested entity are found in one walk over the entries when the first
+        nested table is read, and only the rows of the entity read are then flattened, with
+        the entities they hold replaced by ids. The primary table needs no walk.
+        '''
+
+        if name not in self.rows:
+            norm = self.norm
+            primary = self.names[0]
+            if name == primary:
+                keys = norm._entity_keys(primary)
+                rows = [(v, keys) for v in self.data]
+                entity_id = norm.entities[primary]['id']
+            else:
+                if self.index is None:
+                    self.index = norm._index_entity_rows(self.data)
+                rows = self.index[name]
+                entity_id = norm.entities[primary]['entities'][name]['id']
+            projection = norm.projections.get(name)
+            table = {}
+            for row, keys in rows:
+                row = norm._flatten_row(row, keys, projection)
+                # a primary entry without its id raises as it does in parse
+                if entity_id in row or name == primary:
+                    row_id = row[entity_id]
+                    if projection is not None:
+                        row = projection.rename_flds(row)
+                    norm._store_entity(name, table, row_id, row)
+            self.rows[name] = table
+        return self.rows[name]
+
+    def results(self):
+        '''return the result ids, read from the entries unless the primary is swapped'''
+
+        if self.ids is None:
+            self.ids = list(self._entity_rows(self.norm.swap_primary_to))
+        return self.ids
+
+    def table(self, name):
+        '''return an entity table, adding its one to many keys when first read'''
+
+        if name not in self.tables:
+            if name not in self.names:
+                raise KeyError(name)
+            norm = self.norm
+            table = self._entity_rows(name)
+            keysets = [v for v in norm.new_keys if v['to'] == name]
+            if keysets:
+                if self.indexes is None:
+                    self.indexes = norm._index_new_keys({'entities': dict((v['from'],
+                        self._entity_rows(v['from'])) for v in norm.new_keys)})
+                for keyset in keysets:
+                    table = norm._add_new_key(table, self.indexes[keyset['from']][keyset['to_key']],
+                        keyset['name'])
+            if norm.columnar:
+                table = ColumnTable(table)
+            self.tables[name] = table
+        return self.tables[name]
+
+    def __getitem__(self, key):
+        if key == 'results':
+            return self.results()
+        if key == 'entities':
+            return EntityTables(self)
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def __contains__(self, key):
+        return key in ('results', 'entities')
+
+    def keys(self):
+        return ['results', 'entities']
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return 2
+
+    def __eq__(self, other):
+        return self.to_dict() == (other.to_dict() if isinstance(other, NormalizedResult) else other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def to_dict(self):
+        '''build everything, returning the result parse would have returned'''
+
+        if not self.rows:
+            # with nothing read yet, one walk flattening every table is cheaper
+            self.rows = dict(self.norm._parse_data(self.data)['entities'])
+        return {'results': self.results(), 'entities': dict((v, self.table(v)) for v in self.names)}
+
+class EntityTables(object):
+    '''the entity tables of a NormalizedResult, each built when first read'''
+
+    __slots__ = ('result',)
+
+    def __init__(self, result):
+        self.result = result
+
+    def __getitem__(self, name):
+        return self.result.table(name)
+
+    def get(self, name, default=None):
+        return self.result.table(name) if name in self else default
+
+    def __contains__(self, name):
+        return name in self.result.names
+
+    def keys(self):
+        return list(self.result.names)
+
+    def __iter__(self):
+        return iter(self.result.names)
+
+    def __len__(self):
+        return len(self.result.names)
+
+class _EntityPath(object):
+    '''one level in the tree of entity paths'''
+
+    __slots__ = ('children', 'entity', 'entity_id')
+
+    def __init__(self):
+        self.children = {}
+        self.entity = None
+        self.entity_id = None
+
+    def merge(self, other):
+        '''add the entities and paths of another level that this one does not have'''
+
+        if self.entity is None:
+            self.entity = other.entity
+            self.entity_id = other.entity_id
+        for segment in other.children:
+            self.children.setdefault(segment, _EntityPath()).merge(other.children[segment])
+
+class _EntityFrame(object):
+    '''the rows of an entity value being flattened by _extract'''
+
+    __slots__ = ('entity', 'entity_id', 'keys', 'rows', 'pos', 'table', 'projection', 'ids',
+        'found', 'row', 'copied')
+
+    def __init__(self, entity, entity_id, keys, value, new_data, projection):
+        self.entity = entity
+        self.entity_id = entity_id
+        self.keys = keys
+        self.rows = value if isinstance(value, list) else [value]
+        self.pos = 0
+        self.table = new_data['entities'][entity]
+        self.projection = projection
+        self.ids = []
+        self.found = 0
+        self.row = None
+        self.copied = False
+
+class _Projection(object):
+    '''the field rules of an entity, applied to each of its rows while parsing'''
+
+    __slots__ = ('remove', 'keep', 'rename')
+
+    def __init__(self, remove, keep, rename):
+        self.remove = frozenset(remove)
+        self.keep = frozenset(keep) if keep is not None else None
+        self.rename = tuple(rename)
+
+    def drop(self, row, copy, held=()):
+        '''drop removed fields, or those not kept, other than those in held, copying the row
+        first if copy is set'''
+
+        if self.keep is not None:
+            flds = [v for v in row if v not in self.keep and v not in held]
+        else:
+            flds = [v for v in self.remove if v in row and v not in held]
+        if not flds:
+            return row
+        if copy:
+            flds = set(flds)
+            return dict((v, row[v]) for v in row if v not in flds)
+        for fld in flds:
+            del row[fld]
+        return row
+
+    def keeps(self, fld):
+        '''return whether a field is left in the rows once they are flattened'''
+
+        return fld in self.keep if self.keep is not None else fld not in self.remove
+
+    def rename_flds(self, row):
+        '''rename fields in place'''
+
+        for name, new_name in self.rename:
+            if name in row:
+                row[new_name] = row.pop(name)
+        return row
+
 class Normalize_Base:
 
     def __init__(self):
@@ -15,62 +613,658 @@ class Normalize_Base:
         self.new_keys = []
         self.remove_fldvals = {}
         self.rename_fldvals = {}
+        self.keep_fldvals = {}
+        self.projections = {}
         self.swap_primary_to = None
         self.ignore_flds = []
+        self.preserve_input = False
+        self.dedupe = None
+        self.columnar = False
+        self.lazy = False
+        self.collect_stats = False
+        self.stats = None
+        self.stats_hooks = []
+        self.collect_relations = False
+        self.relations = None
 
     def _set_nested_id(self, data, key, idval, oldval=None):
-        '''recursively replace nested data with an id'''
+        '''replace the first matching nested value with an id, depth first'''
 
-        for index in data:
-            if index == key and (oldval == None or data[index] == oldval or data[index] == [oldval]):
-                data[index] = idval;
-                return True
-            if index not in self.ignore_flds and isinstance(data[index], dict):
-                if self._set_nested_id(data[index], key, idval, oldval):
-                    return True
-            elif index not in self.ignore_flds and isinstance(data[index], list):
-                for row in data[index]:
-                    if index not in self.ignore_flds and isinstance(row, list) or isinstance(row, dict):
-                        if self._set_nested_id(row, key, idval, oldval):
+        # each dict is scanned once and its nested dicts and list rows are pushed in
+        # reverse, so they are visited in order. A match found after a nested container
+        # is pushed as a (row, key) marker and only set once everything before it is
+        # searched
+        ignore = self.ignore_flds
+        stack = [data]
+        pop = stack.pop
+        push = stack.append
+        while stack:
+            node = pop()
+            if isinstance(node, dict):
+                pending = None
+                for index in node:
+                    value = node[index]
+                    if index == key and (oldval == None or value == oldval or value == [oldval]):
+                        if not pending:
+                            node[index] = idval
                             return True
+                        pending.append((node, index))
+                        break
+                    if isinstance(value, dict):
+                        if index not in ignore:
+                            if pending is None:
+                                pending = [value]
+                            else:
+                                pending.append(value)
+                    elif isinstance(value, list) and index not in ignore:
+                        for row in value:
+                            if isinstance(row, (dict, list)):
+                                if pending is None:
+                                    pending = [row]
+                                else:
+                                    pending.append(row)
+                if pending:
+                    pending.reverse()
+                    stack.extend(pending)
+            elif isinstance(node, list):
+                for value in reversed(node):
+                    if isinstance(value, (dict, list)):
+                        push(value)
+            else:
+                node[0][node[1]] = idval
+                return True
         return False
 
     def _search_dict_all(self, data, key, res=None):
-        '''recursive search a dict for a all occurences of a key'''
+        '''search a dict for all occurences of a key, depth first'''
 
         if not res:
             res = []
-        for index in data:
-            if index == key:
-                res.append(data[index])
-            if index not in self.ignore_flds and isinstance(data[index], dict):
-                res = self._search_dict_all(data[index], key, res)
-            elif index not in self.ignore_flds and isinstance(data[index], list):
-                for row in data[index]:
-                    if index not in self.ignore_flds and isinstance(row, list) or isinstance(row, dict):
-                        res = self._search_dict_all(row, key, res)
+        # as in _set_nested_id, a match found after a nested container is pushed as a
+        # (value,) marker to keep matches in the order a depth first search finds them
+        ignore = self.ignore_flds
+        stack = [data]
+        pop = stack.pop
+        push = stack.append
+        while stack:
+            node = pop()
+            if isinstance(node, dict):
+                pending = None
+                for index in node:
+                    value = node[index]
+                    if index == key:
+                        if pending:
+                            pending.append((value,))
+                        else:
+                            res.append(value)
+                    if isinstance(value, dict):
+                        if index not in ignore:
+                            if pending is None:
+                                pending = [value]
+                            else:
+                                pending.append(value)
+                    elif isinstance(value, list) and index not in ignore:
+                        for row in value:
+                            if isinstance(row, (dict, list)):
+                                if pending is None:
+                                    pending = [row]
+                                else:
+                                    pending.append(row)
+                if pending:
+                    pending.reverse()
+                    stack.extend(pending)
+            elif isinstance(node, list):
+                for value in reversed(node):
+                    if isinstance(value, (dict, list)):
+                        push(value)
+            else:
+                res.append(node[0])
         return res
 
     def _get_entity_depth(self, entity, data, depth=1):
         '''determine the nesting depth of a key'''
 
-        for index in data:
-            if index == entity:
+        # a row is searched up to its first nested dict, trying each dict row of any
+        # list before it. Rows are pushed as (row, depth) and a match found after a list
+        # is pushed as (None, depth), returned once the rows before it are searched
+        stack = [(data, depth)]
+        pop = stack.pop
+        while stack:
+            node, depth = pop()
+            if node is None:
                 return depth
-            if isinstance(data[index], dict):
-                depth += 1
-                return self._get_entity_depth(entity, data[index], depth)
-            elif isinstance(data[index], list):
-                for row in data[index]:
-                    res = self._get_entity_depth(entity, row, (depth + 1))
-                    if res and res > depth:
-                        return res
+            pending = None
+            for index in node:
+                if index == entity:
+                    if not pending:
+                        return depth
+                    pending.append((None, depth))
+                    break
+                value = node[index]
+                if isinstance(value, dict):
+                    if pending is None:
+                        pending = []
+                    pending.append((value, depth + 1))
+                    break
+                elif isinstance(value, list):
+                    for row in value:
+                        if isinstance(row, dict):
+                            if pending is None:
+                                pending = []
+                            pending.append((row, depth + 1))
+            if pending:
+                pending.reverse()
+                stack.extend(pending)
+        return None
+
+    def _entity_keys(self, name):
+        '''map each nested entity key to its entity name and id field, for the entities in the
+        entity order or every defined entity if it is not set'''
+
+        entities = self.entities[name]['entities']
+        order = self.entity_order or list(entities)
+        paths = [v for v in order if 'path' in entities[v]]
+        if paths and len(paths) < len(order):
+            raise ValueError('Entities defined by path can not be mixed with those defined by key')
+        if paths:
+            return self._entity_paths(name, order)
+        keys = {}
+        for entity in order:
+            entity_def = entities[entity]
+            keys[entity_def['key']] = (entity, entity_def['id'])
+        return keys
+
+    def _entity_paths(self, name, order):
+        '''build the tree of entity paths, used when every entity is defined by path'''
+
+        root = _EntityPath()
+        for entity in order:
+            entity_def = self.entities[name]['entities'][entity]
+            node = root
+            for segment in entity_def['path']:
+                node = node.children.setdefault(segment, _EntityPath())
+            node.entity = entity
+            node.entity_id = entity_def['id']
+        stack = [root]
+        while stack:
+            node = stack.pop()
+            wildcard = node.children.get('*')
+            if wildcard:
+                # a field with its own path can also be matched by the wildcard
+                for segment in node.children:
+                    if segment != '*':
+                        node.children[segment].merge(wildcard)
+            stack.extend(node.children.values())
+        return root
+
+    def _extract(self, data, keys, new_data, stats=None):
+        '''walk data once, replacing nested entities with ids on the way back up
+
+        The containers and entity rows being walked are kept on a stack instead of recursing,
+        so data nested to any depth can be parsed. keys is either the entity key lookup or
+        the root of the entity path tree. The nodes visited and depth reached are counted
+        into stats if it is given.
+        '''
+
+        preserve = self.preserve_input
+        ignore = self.ignore_flds
+        projections = self.projections
+        counting = stats is not None
+        paths = isinstance(keys, _EntityPath)
+        depth = 0
+        # the container being walked is held in locals, and pushed to the stack as a tuple
+        # while one of its children is walked, below the _EntityFrame of an entity value
+        stack = []
+        start = True
+        while True:
+            if start:
+                start = False
+                is_list = isinstance(data, list)
+                if is_list:
+                    items = enumerate(data)
+                elif paths:
+                    items = self._walk_flds(data, keys)
+                else:
+                    items = iter(data)
+                copy = data
+                if counting:
+                    depth += 1
+                    stats['nodes'] += 1
+                    if depth > stats['max_depth']:
+                        stats['max_depth'] = depth
+            elif result is not None and result is not value:
+                # store the walked child, copying the container on the first change
+                if copy is data and (preserve or is_list):
+                    copy = list(data) if is_list else dict(data)
+                copy[index] = result
+            child = None
+            if is_list:
+                for index, value in items:
+                    if isinstance(value, (dict, list)) and (counting or not _is_leaf(value)):
+                        child = keys
+                        break
+            elif paths:
+                for index in items:
+                    value = data[index]
+                    if isinstance(value, (dict, list)):
+                        child = keys.children.get(index) or keys.children['*']
+                        if child.entity:
+                            child = _EntityFrame(child.entity, child.entity_id, child, value,
+                                new_data, projections.get(child.entity))
+                        break
+            else:
+                for index in items:
+                    value = data[index]
+                    if isinstance(value, (dict, list)):
+                        if index in keys:
+                            entity, entity_id = keys[index]
+                            child = _EntityFrame(entity, entity_id, keys, value, new_data,
+                                projections.get(entity))
+                            break
+                        if index not in ignore and (counting or not _is_leaf(value)):
+                            child = keys
+                            break
+            if child is not None:
+                stack.append((data, keys, copy, items, index, value, is_list))
+                if type(child) is not _EntityFrame:
+                    data, keys = value, child
+                    start = True
+                    continue
+                row = self._next_entity_row(child, stats)
+                if row is not None:
+                    stack.append(child)
+                    data, keys = row, child.keys
+                    start = True
+                    continue
+                result = child.ids if child.found else None
+                data, keys, copy, items, index, value, is_list = stack.pop()
+                continue
+            # the container is done, so hand it back to the entity or container holding it
+            result = copy
+            if counting:
+                depth -= 1
+            while stack:
+                frame = stack.pop()
+                if type(frame) is not _EntityFrame:
+                    data, keys, copy, items, index, value, is_list = frame
+                    break
+                self._finish_entity_row(frame, result, stats)
+                row = self._next_entity_row(frame, stats)
+                if row is not None:
+                    stack.append(frame)
+                    data, keys = row, frame.keys
+                    start = True
+                    break
+                result = frame.ids if frame.found else None
+            else:
+                return result
+
+    def _walk_flds(self, data, node):
+        '''return an iterator over the fields of a dict that lead to entities'''
+
+        if '*' not in node.children:
+            return iter([v for v in node.children if v in data])
+        return iter(data)
+
+    def _entity_flds(self, data, keys):
+        '''yield the field, value and keys to walk the value with of each container held in
+        a dict or list, along with the entity and id field it holds or None, finding them the
+        same way _extract does'''
+
+        if isinstance(data, list):
+            for index, value in enumerate(data):
+                if isinstance(value, (dict, list)) and not _is_leaf(value):
+                    yield index, value, keys, None
+        elif isinstance(keys, _EntityPath):
+            for fld in self._walk_flds(data, keys):
+                value = data[fld]
+                if isinstance(value, (dict, list)):
+                    node = keys.children.get(fld) or keys.children['*']
+                    if node.entity:
+                        yield fld, value, node, (node.entity, node.entity_id)
+                    elif not _is_leaf(value):
+                        yield fld, value, node, None
+        else:
+            for fld in data:
+                value = data[fld]
+                if isinstance(value, (dict, list)):
+                    if fld in keys:
+                        yield fld, value, keys, keys[fld]
+                    elif fld not in self.ignore_flds and not _is_leaf(value):
+                        yield fld, value, keys, None
+
+    def _index_entity_rows(self, entries):
+        '''find the rows of every nested entity without changing them, in the order parse
+        stores them, skipping later copies of an id as parse does with the trust policy'''
+
+        name = self._primary_name()
+        found = dict((v, []) for v in self.entities[name]['entities'])
+        trusted = None
+        if self.dedupe == 'trust':
+            # an id is only trusted once a row with it is stored, which it is not if removed
+            trusted = dict((v, set()) for v in found if v not in self.projections or
+                self.projections[v].keeps(self.entities[name]['entities'][v]['id']))
+        # rows frames hold the rows of an entity value still to walk, and flds frames the
+        # fields of a container being walked along with the entity row it belongs to
+        stack = [('rows', None, None, self._entity_keys(name), iter(entries))]
+        while stack:
+            frame = stack[-1]
+            if frame[0] == 'rows':
+                entity, entity_id, keys, rows = frame[1:]
+                for row in rows:
+                    if not isinstance(row, dict):
+                        continue
+                    if trusted and entity in trusted and entity_id in row and \
+                            row[entity_id] in trusted[entity]:
+                        continue
+                    walked = self._start_row(row, keys, self.projections.get(entity or name))[0]
+                    stack.append(('flds', self._entity_flds(walked, keys), entity and (entity,
+                        entity_id, row, keys)))
+                    break
+                else:
+                    stack.pop()
+                continue
+            for fld, value, child, held in frame[1]:
+                if held is not None:
+                    stack.append(('rows', held[0], held[1], child, iter(value if isinstance(value,
+                        list) else [value])))
+                else:
+                    stack.append(('flds', self._entity_flds(value, child), None))
+                break
+            else:
+                stack.pop()
+                if frame[2] is not None:
+                    entity, entity_id, row, keys = frame[2]
+                    found[entity].append((row, keys))
+                    if trusted and entity in trusted and entity_id in row:
+                        trusted[entity].add(row[entity_id])
+        return found
+
+    def _flatten_row(self, row, keys, projection):
+        '''copy an entity row with the entities it holds replaced by their ids, without
+        walking the rows of those entities'''
+
+        start, copied = self._start_row(row, keys, projection)
+        stack = []
+        data = copy = start
+        flds = self._entity_flds(start, keys)
+        while True:
+            for fld, value, child, held in flds:
+                if held is None:
+                    stack.append((data, copy, flds, fld, value))
+                    data = copy = value
+                    flds = self._entity_flds(value, child)
+                    break
+                rows = [v for v in (value if isinstance(value, list) else [value])
+                    if isinstance(v, dict)]
+                if rows:
+                    if copy is data:
+                        copy = list(data) if isinstance(data, list) else dict(data)
+                    rules = self.projections.get(held[0])
+                    if rules is None or rules.keeps(held[1]):
+                        copy[fld] = [v[held[1]] for v in rows if held[1] in v]
+                    else:
+                        copy[fld] = []
+            else:
+                result = copy
+                if not stack:
+                    return self._finish_row(start, result, copied, projection)
+                data, copy, flds, fld, value = stack.pop()
+                if result is not value:
+                    if copy is data:
+                        copy = list(data) if isinstance(data, list) else dict(data)
+                    copy[fld] = result
+
+    def _next_entity_row(self, frame, stats=None):
+        '''start the next row of an entity value that needs walking, or return None at the end'''
+
+        entity = frame.entity
+        entity_id = frame.entity_id
+        relations = self.relations
+        rows = frame.rows
+        while frame.pos < len(rows):
+            row = rows[frame.pos]
+            frame.pos += 1
+            if not isinstance(row, dict):
+                continue
+            frame.found += 1
+            if self.dedupe == 'trust' and entity_id in row and row[entity_id] in frame.table:
+                if stats is not None:
+                    stats['entities'][entity]['skipped'] += 1
+                if relations is not None:
+                    relations.link(entity, row[entity_id], True)
+                frame.ids.append(row[entity_id])
+                continue
+            if relations is not None:
+                relations.path.append((entity, row.get(entity_id)))
+            if frame.projection is None:
+                frame.row = row
+            else:
+                frame.row, frame.copied = self._start_row(row, frame.keys, frame.projection)
+            return frame.row
         return None
 
+    def _finish_entity_row(self, frame, new_row, stats=None):
+        '''store a walked entity row and add its id'''
+
+        entity = frame.entity
+        entity_id = frame.entity_id
+        if frame.projection is not None:
+            row = self._finish_row(frame.row, new_row, frame.copied, frame.projection)
+        elif new_row is frame.row and self.preserve_input:
+            row = dict(new_row)
+        else:
+            row = new_row
+        if self.relations is not None:
+            self.relations.path.pop()
+            if entity_id in row:
+                self.relations.link(entity, row[entity_id])
+        if entity_id in row:
+            row_id = row[entity_id]
+            if frame.projection is not None:
+                row = frame.projection.rename_flds(row)
+            if stats is not None or (self.dedupe and row_id in frame.table):
+                self._store_entity(entity, frame.table, row_id, row, stats)
+            else:
+                frame.table[row_id] = row
+            frame.ids.append(row_id)
+
+    def _start_row(self, row, keys, projection):
+        '''drop the fields of an entity row that can not hold entities, returning the row and
+        whether it was copied'''
+
+        if projection is None:
+            return row, False
+        if isinstance(keys, _EntityPath):
+            held = row if '*' in keys.children else keys.children
+        else:
+            held = keys
+        dropped = projection.drop(row, self.preserve_input, held)
+        return dropped, dropped is not row
+
+    def _finish_row(self, row, new_row, copied, projection):
+        '''copy a walked entity row to preserve the input and drop its remaining fields'''
+
+        if new_row is row and self.preserve_input and not copied:
+            new_row = dict(row)
+        if projection is not None:
+            new_row = projection.drop(new_row, False)
+        return new_row
+
+    def _entity_row(self, row, keys, new_data, projection=None, stats=None):
+        '''flatten an entity row, copying it to preserve the input. Dropped fields that may
+        hold entities are only dropped once the entities are extracted'''
+
+        row, copied = self._start_row(row, keys, projection)
+        return self._finish_row(row, self._extract(row, keys, new_data, stats), copied,
+            projection)
+
+    def _store_entity(self, entity, table, entity_id, row, stats=None):
+        '''store an entity row, counting it and handling a later copy by the dedupe policy'''
+
+        if stats is not None:
+            counts = stats['entities'][entity]
+            counts['extracted'] += 1
+            if entity_id in table:
+                counts['overwritten' if self.dedupe in (None, 'merge') else 'skipped'] += 1
+        if entity_id not in table or not self.dedupe:
+            table[entity_id] = row
+        elif self.dedupe == 'merge':
+            table[entity_id] = self._merge_rows(table[entity_id], row, self.preserve_input)
+        elif self.dedupe == 'compare' and table[entity_id] != row:
+            raise ValueError('Entity "%s" has conflicting copies of id %s' % (entity, entity_id))
+
+    def _parse_stats(self, data):
+        '''parse while counting the work done and timing each phase'''
+
+        name = self._primary_name()
+        stats = {'nodes': 0, 'max_depth': 0, 'entities': dict((v, {'extracted': 0,
+            'overwritten': 0, 'skipped': 0}) for v in self.entities[name]['entities']),
+            'time': dict((v, 0.0) for v in STATS_PHASES)}
+        start = time.time()
+        data = self._post_process(self._parse_data(data, stats), stats)
+        times = stats['time']
+        times['total'] = time.time() - start
+        times['extract'] = times['total'] - sum(times[v] for v in STATS_PHASES)
+        self.stats = stats
+        for hook in self.stats_hooks:
+            hook(stats)
+        return data
+
+    def _timed(self, stats, phase, method, *args):
+        '''call a method, adding its run time to a phase if statistics are being collected'''
+
+        if stats is None:
+            return method(*args)
+        start = time.time()
+        try:
+            return method(*args)
+        finally:
+            stats['time'][phase] += time.time() - start
+
+    def _parse_entry(self, name, id_key, keys, entry, new_data, stats=None):
+        '''flatten a single primary entry into new_data'''
+
+        if id_key not in entry:
+            raise ValueError('Id key "%s" missing from data' % id_key)
+
+        projection = self.projections.get(name)
+        if self.relations is not None:
+            self.relations.path.append((name, entry[id_key]))
+            entry = self._entity_row(entry, keys, new_data, projection, stats)
+            self.relations.path.pop()
+        else:
+            entry = self._entity_row(entry, keys, new_data, projection, stats)
+        entry_id = entry[id_key]
+        if projection is not None:
+            entry = projection.rename_flds(entry)
+        table = new_data['entities'][name]
+        if self.dedupe and entry_id in table:
+            self._store_entity(name, table, entry_id, entry)
+        else:
+            table[entry_id] = entry
+        new_data['results'].append(entry_id)
+
+    def _parse_data(self, data, stats=None):
+        '''flatten a list of entries without the primary swap or new keys'''
+
+        name, id_key, new_data = self._base_data()
+        self._timed(stats, 'field_changes', self._set_projections, name)
+        if self.collect_relations:
+            self.relations = RelationIndex(name)
+        keys = self._timed(stats, 'order', self._entity_keys, name)
+        for entry in data:
+            self._parse_entry(name, id_key, keys, entry, new_data, stats)
+        return new_data
+
+    def _post_process(self, data, stats=None):
+        '''process the primary swap and new keys once all entries are flattened'''
+
+        if self.swap_primary_to:
+            data = self._timed(stats, 'primary_swap', self._process_primary_swap, data)
+        if self.new_keys:
+            data = self._timed(stats, 'new_keys', self._process_new_keys, data)
+        if self.columnar:
+            data = self._timed(stats, 'columns', self._process_columns, data)
+        return data
+
+    def _process_columns(self, data):
+        '''convert every entity table into a ColumnTable'''
+
+        for entity in data['entities']:
+            data['entities'][entity] = ColumnTable(data['entities'][entity])
+        return data
+
+    def _merge_data(self, data, shard, conflict):
+        '''merge the results and entity tables of a flattened shard into data'''
+
+        data['results'].extend(shard['results'])
+        for entity in shard['entities']:
+            table = data['entities'][entity]
+            rows = shard['entities'][entity]
+            for entity_id in rows:
+                if entity_id not in table or conflict == 'last':
+                    table[entity_id] = rows[entity_id]
+                elif conflict == 'merge':
+                    table[entity_id] = self._merge_rows(table[entity_id], rows[entity_id])
+        return data
+
+    def _merge_rows(self, old, new, copy=False):
+        '''recursively merge two versions of an entity, preferring the new values. With copy,
+        the merge is made into new dicts so rows from the input are left unchanged'''
+
+        if copy:
+            old = dict(old)
+        for fld in new:
+            if isinstance(old.get(fld), dict) and isinstance(new[fld], dict):
+                old[fld] = self._merge_rows(old[fld], new[fld], copy)
+            else:
+                old[fld] = new[fld]
+        return old
+
+    def _parse_chunks(self, data, chunk_size):
+        '''flatten an iterable of entries, yielding new_data every chunk_size entries'''
+
+        name, id_key, new_data = self._base_data()
+        seen = dict((entity, set()) for entity in new_data['entities'])
+        if self.collect_relations:
+            self.relations = RelationIndex(name)
+        self._set_projections(name)
+        keys = self._entity_keys(name)
+        count = 0
+        for entry in data:
+            self._parse_entry(name, id_key, keys, entry, new_data)
+            count += 1
+            if count == chunk_size:
+                yield self._finish_chunk(new_data, seen)
+                new_data = self._base_data()[2]
+                count = 0
+        if count:
+            yield self._finish_chunk(new_data, seen)
+
+    def _finish_chunk(self, data, seen):
+        '''drop entities emitted by an earlier chunk and remember the new ids'''
+
+        for entity in data['entities']:
+            table = data['entities'][entity]
+            for entity_id in [v for v in table if v in seen[entity]]:
+                del table[entity_id]
+            seen[entity].update(table)
+        if self.swap_primary_to:
+            data = self._process_primary_swap(data)
+        if self.columnar:
+            data = self._process_columns(data)
+        return data
+
+    def _primary_name(self):
+        '''return the name of the primary entity'''
+
+        return next(iter(self.entities))
+
     def _base_data(self):
         '''setup the basic wrapper around the newly normalized data'''
 
-        name = self.entities.keys()[0]
+        name = self._primary_name()
         id_key = self.entities[name]['id']
         new_data = {'results': [], 'entities': {name: {}}}
         for entity in self.entities[name]['entities']:
@@ -85,10 +1279,24 @@ class Normalize_Base:
             key = self.entities[name]['entities'][entity]['key']
             level = self._get_entity_depth(key, row)
             data.append([level, entity])
-        data.sort(key=lambda x:x[0])
+        data.sort(key=lambda x:x[0] or 0)
         self.entity_order = [v[1] for v in data]
         self.entity_order.reverse()
 
+    def _set_projections(self, name):
+        '''build the projection of every entity with field rules'''
+
+        nested = self.entities[name]['entities']
+        ids = dict((v, nested[v]['id']) for v in nested)
+        ids[name] = self.entities[name]['id']
+        self.projections = {}
+        for entity in ids:
+            keep = self.keep_fldvals.get(entity)
+            if entity in self.remove_fldvals or entity in self.rename_fldvals or keep is not None:
+                self.projections[entity] = _Projection(self.remove_fldvals.get(entity, ()),
+                    None if keep is None else list(keep) + [ids[entity]],
+                    self.rename_fldvals.get(entity, ()))
+
     def _process_data_changes(self, entity, data):
         '''process renaming and removing fields from entities'''
 
@@ -116,11 +1324,12 @@ class Normalize_Base:
         return data
 
     def _process_primary_swap(self, data):
-        '''process a change in primery entity'''
+        '''process a change in primery entity. The new results follow the order of the entity
+        table, which is the order the ids were first extracted in on Python 3'''
 
         if self.swap_primary_to not in data['entities']:
             raise ValueError('New primary entity does not exist')
-        data['results'] = data['entities'][self.swap_primary_to].keys()
+        data['results'] = list(data['entities'][self.swap_primary_to])
         return data
 
     def _process_new_keys(self, data):
@@ -129,21 +1338,55 @@ class Normalize_Base:
         for keyset in self.new_keys:
             if keyset['to'] not in data['entities'] or keyset['from'] not in data['entities']:
                 raise ValueError('Invalid entity used in one to many key creation')
-            data['entities'][keyset['to']] = self._add_new_key(data['entities'][keyset['to']], data['entities'][keyset['from']],
-                keyset['name'], keyset['to_key'])
+        indexes = self._index_new_keys(data)
+        for keyset in self.new_keys:
+            data['entities'][keyset['to']] = self._add_new_key(data['entities'][keyset['to']],
+                indexes[keyset['from']][keyset['to_key']], keyset['name'])
         return data
 
-    def _add_new_key(self, to_data, from_data, name, to_key):
-        for to_id in to_data:
-            keys = []
+    def _index_new_keys(self, data):
+        '''group the from entities of every new key by their to key values in one pass'''
+
+        indexes = {}
+        for keyset in self.new_keys:
+            indexes.setdefault(keyset['from'], {})[keyset['to_key']] = {}
+        for entity in indexes:
+            index = indexes[entity]
+            from_data = data['entities'][entity]
             for from_id in from_data:
-                if to_key in from_data[from_id]:
-                    if from_data[from_id][to_key] == to_id:
-                        keys.append(from_id)
-            to_data[to_id][name] = keys
+                row = from_data[from_id]
+                for to_key in index:
+                    for value in self._key_values(row, to_key):
+                        keys = index[to_key].setdefault(value, [])
+                        if not keys or keys[-1] != from_id:
+                            keys.append(from_id)
+        return indexes
+
+    def _key_values(self, row, to_key):
+        '''return the ids that a row refers to through a to key'''
 
+        if to_key not in row:
+            return []
+        values = row[to_key] if isinstance(row[to_key], list) else [row[to_key]]
+        return [v for v in values if not isinstance(v, (dict, list))]
+
+    def _add_new_key(self, to_data, index, name):
+        '''add the grouped from ids to each to entity'''
+
+        for to_id in to_data:
+            to_data[to_id][name] = list(index.get(to_id, []))
         return to_data
 
+    def denormalize(self, data, depth=None, lazy=False):
+        '''rebuild nested records from normalized data, nesting entities up to depth levels'''
+
+        rebuild = _Denormalizer(self, data['entities'])
+        name = self.swap_primary_to or self._primary_name()
+        keys = rebuild.entity_keys(name)
+        if lazy:
+            return [rebuild.lazy_entity(name, v, depth, keys) for v in data['results']]
+        return [rebuild.entity(name, v, depth, keys) for v in data['results']]
+
 class Normalize(Normalize_Base):
 
     def swap_primary(self, name):
@@ -161,6 +1404,43 @@ class Normalize(Normalize_Base):
         '''set the keys to ignore'''
         self.ignore_flds = keys
 
+    def set_preserve_input(self, preserve=True):
+        '''leave the parsed data untouched, copying only the rows that change'''
+        self.preserve_input = preserve
+
+    def set_dedupe(self, policy='trust'):
+        '''keep the first copy of each entity id, handling later copies with a policy'''
+
+        if policy is not None and policy not in DEDUPE_POLICIES:
+            raise ValueError('Dedupe policy must be one of %s' % ', '.join(DEDUPE_POLICIES))
+        self.dedupe = policy
+
+    def set_columnar(self, columnar=True):
+        '''return entity tables as ColumnTable objects instead of dicts of rows'''
+        self.columnar = columnar
+
+    def set_lazy(self, lazy=True):
+        '''return a NormalizedResult from parse, which builds each table when first read'''
+
+        self.lazy = lazy
+
+    def set_stats(self, enabled=True):
+        '''collect statistics on each parse into self.stats'''
+        self.collect_stats = enabled
+
+    def set_relations(self, enabled=True):
+        '''record the links between entities on each parse into self.relations'''
+
+        self.collect_relations = enabled
+        if not enabled:
+            self.relations = None
+
+    def add_stats_hook(self, hook):
+        '''call hook with the statistics after each parse, enabling statistics'''
+
+        self.stats_hooks.append(hook)
+        self.collect_stats = True
+
     def set_entity_order(self, order):
         '''set the nested depth order (deepest first)'''
 
@@ -171,9 +1451,20 @@ class Normalize(Normalize_Base):
 
         if not len(self.entities):
             raise ValueError('You must set the primary first')
-        self.entities[self.entities.keys()[0]]['entities'][name] = {
+        self.entities[self._primary_name()]['entities'][name] = {
             'id': id_fld, 'key': keyval}
 
+    def define_nested_path(self, name, path, id_fld='id'):
+        '''set a nested entity to be flattened, found only at a dotted path of keys'''
+
+        if not len(self.entities):
+            raise ValueError('You must set the primary first')
+        segments = tuple(path.split('.'))
+        if not all(segments):
+            raise ValueError('Invalid entity path "%s"' % path)
+        self.entities[self._primary_name()]['entities'][name] = {
+            'id': id_fld, 'key': segments[-1], 'path': segments}
+
     def remove_flds(self, entity, fld):
         '''remove a field from a defined entity'''
 
@@ -182,6 +1473,14 @@ class Normalize(Normalize_Base):
         else:
             self.remove_fldvals[entity] = [fld]
 
+    def keep_flds(self, entity, fld):
+        '''keep only this and any other kept fields of a defined entity, along with its id'''
+
+        if entity in self.keep_fldvals:
+            self.keep_fldvals[entity].append(fld)
+        else:
+            self.keep_fldvals[entity] = [fld]
+
     def rename_flds(self, entity, name, new_name):
         '''rename a field for an entity'''
 
@@ -200,43 +1499,527 @@ class Normalize(Normalize_Base):
 
         if not data:
             return None
-        name, id_key, new_data = self._base_data()
-        if not self.entity_order:
-            self._get_entity_order(name, data[0])
-        for entry in data:
-            if id_key not in entry:
-                raise ValueError('Id key "%s" missing from data' % id_key)
+        if self.lazy:
+            if self.collect_stats or self.collect_relations:
+                raise ValueError('Statistics and relation indexes are not supported when lazy')
+            # the settings are compiled so later changes do not affect the result
+            return self.compile().parse(data)
+        if self.collect_stats:
+            return self._parse_stats(data)
+        return self._post_process(self._parse_data(data))
 
-            for entity in self.entity_order:
-                entity_id = self.entities[name]['entities'][entity]['id']
-                entity_key = self.entities[name]['entities'][entity]['key']
-                match = self._search_dict_all(entry, entity_key)
-                if isinstance(match, list):
-                    ids = []
-                    updated = 0
-                    for row in match:
-                        if isinstance(row, list):
-                            ids = []
-                            for subrow in row:
-                                if entity_id in subrow:
-                                    new_data['entities'][entity][subrow[entity_id]] = subrow
-                                    ids.append(subrow[entity_id])
-                            if ids:
-                                if self._set_nested_id(entry, entity_key, ids, subrow):
-                                    updated += 1
+    def parse_parallel(self, data, workers=None, conflict='last', shard_size=None):
+        '''convert data in shards across a pool of worker processes'''
 
-                        else:
-                            if entity_id in row:
-                                new_data['entities'][entity][row[entity_id]] = row
-                                ids.append(row[entity_id])
-                    if len(match) != updated and isinstance(ids, list):
-                        self._set_nested_id(entry, entity_key, ids)
-
-            entry = self._process_data_changes(name, entry)
-            new_data['entities'][name][entry[id_key]] = entry
-            new_data['results'].append(entry[id_key])
-        if self.swap_primary_to:
-            new_data = self._process_primary_swap(new_data)
+        if conflict not in CONFLICT_POLICIES:
+            raise ValueError('Conflict policy must be one of %s' % ', '.join(CONFLICT_POLICIES))
+        if self.collect_relations:
+            raise ValueError('Relation indexes are not supported when parsing in parallel')
+        if self.collect_stats:
+            raise ValueError('Statistics are not supported when parsing in parallel')
+        if not data:
+            return None
+        workers = workers or multiprocessing.cpu_count()
+        if not shard_size:
+            shard_size = max(1, -(-len(data) // (workers * 4)))
+        # apply the conflict policy within each shard too, keeping the first copy of an id
+        # without skipping it for first, unless a dedupe policy is set
+        dedupe = self.dedupe or {'first': 'first', 'merge': 'merge'}.get(conflict)
+        shards = [(self, dedupe, i, i + shard_size) for i in range(0, len(data), shard_size)]
+        new_data = self._base_data()[2]
+        pool = multiprocessing.Pool(workers, _init_shard, (data,))
+        try:
+            for shard in pool.imap(_parse_shard, shards):
+                new_data = self._merge_data(new_data, shard, conflict)
+        finally:
+            pool.close()
+            pool.join()
+        return self._post_process(new_data)
+
+    def parse_iter(self, data, chunk_size=1000):
+        '''convert an iterable of data, yielding a normalized chunk every chunk_size entries'''
+
+        if chunk_size < 1:
+            raise ValueError('Chunk size must be at least 1')
         if self.new_keys:
-            new_data = self._process_new_keys(new_data)
+            raise ValueError('One to many keys are not supported when parsing in chunks')
+        if self.collect_stats:
+            raise ValueError('Statistics are not supported when parsing in chunks')
+        return self._parse_chunks(data, chunk_size)
+
+    def compile(self):
+        '''freeze the current settings into a NormalizePlan that can be shared between threads'''
+
+        return NormalizePlan(self)
+
+class NormalizePlan(Normalize_Base):
+    '''an immutable, compiled copy of the settings of a Normalize instance'''
+
+    def __init__(self, norm):
+        '''copy and check the settings, precomputing the entity key lookup'''
+
+        if not norm.entities:
+            raise ValueError('You must set the primary first')
+        Normalize_Base.__init__(self)
+        name = norm._primary_name()
+        nested = norm.entities[name]['entities']
+        self.entities = {name: {'id': norm.entities[name]['id'], 'entities': dict((v,
+            dict(nested[v])) for v in nested)}}
+        self.entity_order = tuple(norm.entity_order or nested)
+        self.new_keys = tuple(dict(v) for v in norm.new_keys)
+        self.remove_fldvals = dict((v, tuple(norm.remove_fldvals[v])) for v in norm.remove_fldvals)
+        self.rename_fldvals = dict((v, tuple(norm.rename_fldvals[v])) for v in norm.rename_fldvals)
+        self.keep_fldvals = dict((v, tuple(norm.keep_fldvals[v])) for v in norm.keep_fldvals)
+        self.swap_primary_to = norm.swap_primary_to
+        self.ignore_flds = frozenset(norm.ignore_flds)
+        # a lazy result is flattened after parse returns, so it must leave the input as it is
+        self.preserve_input = norm.preserve_input or norm.lazy
+        self.dedupe = norm.dedupe
+        self.columnar = norm.columnar
+        self.lazy = norm.lazy
+        self.keys = Normalize_Base._entity_keys(self, name)
+        Normalize_Base._set_projections(self, name)
+        names = set(nested) | set([name])
+        if self.swap_primary_to and self.swap_primary_to not in names:
+            raise ValueError('New primary entity does not exist')
+        for keyset in self.new_keys:
+            if keyset['to'] not in names or keyset['from'] not in names:
+                raise ValueError('Invalid entity used in one to many key creation')
+        self.frozen = True
+
+    def __setattr__(self, name, value):
+        if self.__dict__.get('frozen'):
+            raise AttributeError('A compiled NormalizePlan can not be changed')
+        self.__dict__[name] = value
+
+    def _entity_keys(self, name):
+        '''return the entity key lookup built when compiled'''
+
+        return self.keys
+
+    def _set_projections(self, name):
+        '''the projections are built when compiled'''
+
+        pass
+
+    def parse(self, data):
+        '''convert data'''
+
+        if not data:
+            return None
+        if self.lazy:
+            return NormalizedResult(self, data)
+        return self._post_process(self._parse_data(data))
+
+    def parse_iter(self, data, chunk_size=1000):
+        '''convert an iterable of data, yielding a normalized chunk every chunk_size entries'''
+
+        if chunk_size < 1:
+            raise ValueError('Chunk size must be at least 1')
+        if self.new_keys:
+            raise ValueError('One to many keys are not supported when parsing in chunks')
+        return self._parse_chunks(data, chunk_size)
+
+
+class NormalizedStore(object):
+    '''keep normalized entity tables between calls and merge new batches into them'''
+
+    def __init__(self, norm):
+        '''start an empty store for a configured Normalize instance'''
+
+        self.norm = norm
+        self.data = norm._base_data()[2]
+        if norm.swap_primary_to and norm.swap_primary_to not in self.data['entities']:
+            raise ValueError('New primary entity does not exist')
+        for keyset in norm.new_keys:
+            if keyset['to'] not in self.data['entities'] or keyset['from'] not in self.data['entities']:
+                raise ValueError('Invalid entity used in one to many key creation')
+        self.results_name = norm.swap_primary_to or norm._base_data()[0]
+        self.result_ids = set()
+        self.links = [{} for v in norm.new_keys]
+
+    def merge(self, batch, removed=None):
+        '''normalize a batch, upsert it into the stored tables and return the delta'''
+
+        if self.norm.collect_stats:
+            raise ValueError('Statistics are not supported when merging into a store')
+        delta = {'results': [], 'entities': {}, 'added': {}, 'changed': {}, 'removed': {}}
+        touched = set()
+        for entity in (removed or {}):
+            for entity_id in removed[entity]:
+                self._remove(entity, entity_id, delta, touched)
+        new_data = self.norm._parse_data(batch) if batch else {'entities': {}, 'results': []}
+        for entity in new_data['entities']:
+            rows = new_data['entities'][entity]
+            for entity_id in rows:
+                if entity_id in self.data['entities'][entity]:
+                    self._unlink(entity, entity_id, self.data['entities'][entity][entity_id], touched,
+                        rows[entity_id])
+                self._link(entity, entity_id, rows[entity_id], touched)
+        for entity in new_data['entities']:
+            rows = new_data['entities'][entity]
+            for entity_id in rows:
+                touched.discard((entity, entity_id))
+                self._upsert(entity, entity_id, rows[entity_id], delta)
+        for entity, entity_id in touched:
+            if entity_id in self.data['entities'][entity]:
+                self._upsert(entity, entity_id, dict(self.data['entities'][entity][entity_id]), delta)
+        if not self.norm.swap_primary_to:
+            for entity_id in new_data['results']:
+                self._add_result(entity_id, delta)
+        return delta
+
+    def _upsert(self, entity, entity_id, row, delta):
+        '''store a row with its one to many keys, recording it in the delta if it changed'''
+
+        for i, keyset in enumerate(self.norm.new_keys):
+            if keyset['to'] == entity:
+                row[keyset['name']] = list(self.links[i].get(entity_id, []))
+        table = self.data['entities'][entity]
+        if entity_id not in table:
+            delta['added'].setdefault(entity, []).append(entity_id)
+        elif table[entity_id] != row:
+            delta['changed'].setdefault(entity, []).append(entity_id)
+        else:
+            return
+        table[entity_id] = row
+        delta['entities'].setdefault(entity, {})[entity_id] = row
+        if entity == self.results_name and self.norm.swap_primary_to:
+            self._add_result(entity_id, delta)
+
+    def _remove(self, entity, entity_id, delta, touched):
+        '''remove a stored row and any links from it'''
+
+        table = self.data['entities'][entity]
+        if entity_id not in table:
+            return
+        self._unlink(entity, entity_id, table.pop(entity_id), touched)
+        delta['removed'].setdefault(entity, []).append(entity_id)
+        if entity == self.results_name and entity_id in self.result_ids:
+            self.result_ids.remove(entity_id)
+            self.data['results'].remove(entity_id)
+
+    def _add_result(self, entity_id, delta):
+        '''append a new id to the results'''
+
+        if entity_id not in self.result_ids:
+            self.result_ids.add(entity_id)
+            self.data['results'].append(entity_id)
+            delta['results'].append(entity_id)
+
+    def _link(self, entity, entity_id, row, touched):
+        '''add the one to many links from a row'''
+
+        for i, keyset in enumerate(self.norm.new_keys):
+            if keyset['from'] == entity:
+                for value in self.norm._key_values(row, keyset['to_key']):
+                    keys = self.links[i].setdefault(value, [])
+                    if entity_id not in keys:
+                        keys.append(entity_id)
+                        touched.add((keyset['to'], value))
+
+    def _unlink(self, entity, entity_id, row, touched, new_row=None):
+        '''remove the one to many links from a row, keeping those the new version of the row
+        still has in place'''
+
+        for i, keyset in enumerate(self.norm.new_keys):
+            if keyset['from'] == entity:
+                kept = self.norm._key_values(new_row, keyset['to_key']) if new_row else []
+                for value in self.norm._key_values(row, keyset['to_key']):
+                    if value in kept:
+                        continue
+                    keys = self.links[i].get(value, [])
+                    if entity_id in keys:
+                        keys.remove(entity_id)
+                        touched.add((keyset['to'], value))
+
+class NormalizeBatch(object):
+    '''normalize several primary collections at once into one shared set of entity tables'''
+
+    def __init__(self):
+        '''start a batch with no primary collections'''
+
+        self.members = []
+        self.entity_ids = {}
+
+    def add_primary(self, norm, collection=None):
+        '''add a configured Normalize instance for the entries held under a collection key,
+        which defaults to the name of its primary entity'''
+
+        if not norm.entities:
+            raise ValueError('You must set the primary first')
+        name = norm._primary_name()
+        collection = collection or name
+        if collection in [v[0] for v in self.members]:
+            raise ValueError('Collection "%s" is already defined' % collection)
+        nested = norm.entities[name]['entities']
+        ids = dict((v, nested[v]['id']) for v in nested)
+        ids[name] = norm.entities[name]['id']
+        for entity in ids:
+            if self.entity_ids.get(entity, ids[entity]) != ids[entity]:
+                raise ValueError('Entity "%s" is defined with different id fields' % entity)
+        self.entity_ids.update(ids)
+        self.members.append((collection, norm))
+
+    def parse(self, data):
+        '''convert a dict of collections of entries, with the ids of each collection in results'''
+
+        if not data:
+            return None
+        if not self.members:
+            raise ValueError('You must add a primary first')
+        for collection, norm in self.members:
+            if norm.collect_stats:
+                raise ValueError('Statistics are not supported when parsing a batch')
+        entities = dict((v, {}) for v in self.entity_ids)
+        results = {}
+        for collection, norm in self.members:
+            # every collection is flattened straight into the shared tables, except for the
+            # entity its primary is swapped to, which is collected apart so the results only
+            # hold the ids found in this collection
+            name, id_key = norm._base_data()[:2]
+            swap = norm.swap_primary_to
+            tables = entities
+            if swap:
+                if swap not in entities:
+                    raise ValueError('New primary entity does not exist')
+                tables = dict(entities)
+                tables[swap] = {}
+            new_data = {'results': [], 'entities': tables}
+            rows = data.get(collection) or []
+            norm._set_projections(name)
+            if norm.collect_relations:
+                norm.relations = RelationIndex(name)
+            keys = norm._entity_keys(name)
+            for entry in rows:
+                norm._parse_entry(name, id_key, keys, entry, new_data)
+            if swap:
+                found = tables[swap]
+                for entity_id in found:
+                    norm._store_entity(swap, entities[swap], entity_id, found[entity_id])
+                results[collection] = list(found)
+            else:
+                results[collection] = new_data['results']
+        new_data = {'results': results, 'entities': entities}
+        for collection, norm in self.members:
+            view = {'results': results[collection], 'entities': entities}
+            if norm.new_keys:
+                view = norm._process_new_keys(view)
+            results[collection] = view['results']
+        if any(v[1].columnar for v in self.members):
+            new_data = self.members[0][1]._process_columns(new_data)
         return new_data
+
+_shard_data = None
+
+def _init_shard(data):
+    '''hand the full data set to a worker process, inherited without pickling when forked'''
+
+    global _shard_data
+    _shard_data = data
+
+def _parse_shard(args):
+    '''flatten one shard of entries in a worker process'''
+
+    norm, dedupe, start, stop = args
+    norm.dedupe = dedupe
+    return norm._parse_data(_shard_data[start:stop])
+
+_JSON_WS = re.compile(r'\s*')
+_JSON_SEP = re.compile(r'[\s,]*')
+_DONE = object()
+
+def load_schema(schema):
+    '''build a Normalize instance from a schema definition, or a NormalizeBatch from a
+    schema listing several primaries'''
+
+    if 'primaries' in schema:
+        batch = NormalizeBatch()
+        for primary in schema['primaries']:
+            batch.add_primary(load_schema(primary), primary.get('collection'))
+        return batch
+    if 'primary' not in schema:
+        raise ValueError('Schema is missing the primary entity')
+    norm = Normalize()
+    norm.define_primary(schema['primary'], schema.get('id', 'id'))
+    for entity in schema.get('entities', []):
+        if 'path' in entity:
+            norm.define_nested_path(entity['name'], entity['path'], entity.get('id', 'id'))
+        else:
+            norm.define_nested_entity(entity['name'], entity['key'], entity.get('id', 'id'))
+    for entity in schema.get('rename', {}):
+        for name, new_name in schema['rename'][entity].items():
+            norm.rename_flds(entity, name, new_name)
+    for entity in schema.get('remove', {}):
+        for fld in schema['remove'][entity]:
+            norm.remove_flds(entity, fld)
+    for entity in schema.get('keep', {}):
+        for fld in schema['keep'][entity]:
+            norm.keep_flds(entity, fld)
+    if 'ignore' in schema:
+        norm.set_ignore_keys(schema['ignore'])
+    if 'order' in schema:
+        norm.set_entity_order(schema['order'])
+    if 'swap_primary' in schema:
+        norm.swap_primary(schema['swap_primary'])
+    if 'dedupe' in schema:
+        norm.set_dedupe(schema['dedupe'])
+    for keyset in schema.get('one_to_many', []):
+        norm.add_one_to_many_key(keyset['name'], keyset['to_key'], keyset['to'], keyset['from'])
+    return norm
+
+def iter_json(fp, size=65536):
+    '''incrementally decode the rows of a JSON array or JSON Lines file'''
+
+    decoder = json.JSONDecoder()
+    buf = ''
+    pos = 0
+    eof = False
+    array = None
+    while True:
+        pos = (_JSON_SEP if array else _JSON_WS).match(buf, pos).end()
+        if pos < len(buf):
+            if array is None:
+                array = buf[pos] == '['
+                if array:
+                    pos += 1
+                continue
+            if array and buf[pos] == ']':
+                return
+            try:
+                row, end = decoder.raw_decode(buf, pos)
+            except ValueError:
+                if eof:
+                    raise
+                end = None
+            if end is not None and (end < len(buf) or eof):
+                pos = end
+                yield row
+                continue
+        elif eof:
+            if array:
+                raise ValueError('Unterminated JSON array')
+            return
+        chunk = fp.read(size)
+        eof = not chunk
+        buf = buf[pos:] + chunk
+        pos = 0
+
+def _background(iterable, size=8, batch=256):
+    '''iterate in a background thread, handing rows over in batches through a bounded queue'''
+
+    rows = queue.Queue(size)
+
+    def run():
+        try:
+            items = []
+            for item in iterable:
+                items.append(item)
+                if len(items) == batch:
+                    rows.put(items)
+                    items = []
+            if items:
+                rows.put(items)
+            rows.put(_DONE)
+        except Exception as e:
+            rows.put(e)
+
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+    while True:
+        items = rows.get()
+        if items is _DONE:
+            return
+        if isinstance(items, Exception):
+            raise items
+        for item in items:
+            yield item
+
+def _json_key(key):
+    '''encode an id as a JSON object key, converting other types as json.dumps does'''
+
+    return json.dumps(key if isinstance(key, _STRING_TYPES) else json.dumps(key))
+
+def _write_chunks(fp, items, chunk_size):
+    '''write encoded items separated by commas, joining chunk_size of them per write'''
+
+    items = iter(items)
+    sep = ''
+    while True:
+        chunk = list(itertools.islice(items, chunk_size))
+        if not chunk:
+            return
+        fp.write(sep + ', '.join(chunk))
+        sep = ', '
+
+def write_json(data, fp, chunk_size=1000):
+    '''write normalized data to a file-like object as JSON, chunk_size rows at a time'''
+
+    fp.write('{')
+    for i, name in enumerate(data):
+        fp.write('%s%s: ' % (', ' if i else '', _json_key(name)))
+        value = data[name]
+        if name == 'entities':
+            fp.write('{')
+            for j, entity in enumerate(value):
+                table = value[entity]
+                fp.write('%s%s: {' % (', ' if j else '', _json_key(entity)))
+                _write_chunks(fp, ('%s: %s' % (_json_key(v), json.dumps(table[v].to_dict()
+                    if isinstance(table, ColumnTable) else table[v])) for v in table), chunk_size)
+                fp.write('}')
+            fp.write('}')
+        elif isinstance(value, list):
+            fp.write('[')
+            _write_chunks(fp, (json.dumps(v) for v in value), chunk_size)
+            fp.write(']')
+        else:
+            fp.write(json.dumps(value))
+    fp.write('}')
+
+def normalize_stream(norm, infile, outfile, chunk_size=1000):
+    '''normalize a JSON array or JSON Lines file, writing one JSON line per chunk'''
+
+    if isinstance(norm, NormalizeBatch):
+        # a batch is a single JSON object of collections, written as one line
+        write_json(norm.parse(json.load(infile)), outfile)
+        outfile.write('\n')
+        return
+    data = _background(iter_json(infile))
+    if norm.new_keys:
+        chunks = [norm.parse(list(data))]
+    else:
+        chunks = _background(norm.parse_iter(data, chunk_size), batch=1)
+    for chunk in chunks:
+        if chunk is None:
+            continue
+        write_json(chunk, outfile)
+        outfile.write('\n')
+
+def main(argv=None):
+    '''command line entry point'''
+
+    parser = argparse.ArgumentParser(prog='python -m norm',
+        description='Normalize a JSON array or JSON Lines file into JSON Lines chunks')
+    parser.add_argument('schema', help='JSON schema definition file')
+    parser.add_argument('input', nargs='?', default='-', help='input file, defaults to stdin')
+    parser.add_argument('-o', '--output', default='-', help='output file, defaults to stdout')
+    parser.add_argument('-c', '--chunk-size', type=int, default=1000,
+        help='primary entries per output chunk')
+    args = parser.parse_args(argv)
+
+    with open(args.schema) as fp:
+        norm = load_schema(json.load(fp))
+    infile = sys.stdin if args.input == '-' else open(args.input)
+    outfile = sys.stdout if args.output == '-' else open(args.output, 'w')
+    try:
+        normalize_stream(norm, infile, outfile, args.chunk_size)
+    finally:
+        if infile is not sys.stdin:
+            infile.close()
+        if outfile is not sys.stdout:
+            outfile.close()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
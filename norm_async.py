@@ -0,0 +1,67 @@
+#!/usr/bin/python
+
+# Asyncio support for normalizing paginated sources, kept apart from norm.py as it
+# needs Python 3.5 or later. Each page is normalized while the next one is fetched.
+
+import asyncio
+
+from norm import RelationIndex
+
+_DONE = object()
+
+async def _next_page(pages):
+    '''fetch the next page, or _DONE at the end of the pages'''
+
+    try:
+        return await pages.__anext__()
+    except StopAsyncIteration:
+        return _DONE
+
+def _parse_page(norm, name, id_key, keys, page, new_data):
+    '''flatten the entries of a page into the running result'''
+
+    for entry in page:
+        norm._parse_entry(name, id_key, keys, entry, new_data)
+
+async def parse_pages(norm, pages, executor=None):
+    '''convert an async iterator of pages of data into one result, as parse does for
+    the pages joined together
+
+    Each page is normalized while the next one is fetched. Pass an executor, such as
+    a ThreadPoolExecutor, to normalize away from the event loop.
+    '''
+
+    if norm.collect_stats:
+        raise ValueError('Statistics are not supported when parsing pages')
+    loop = asyncio.get_event_loop()
+    name, id_key, new_data = norm._base_data()
+    keys = None
+    pages = pages.__aiter__()
+    fetch = asyncio.ensure_future(_next_page(pages))
+    try:
+        while True:
+            page = await fetch
+            if page is _DONE:
+                break
+            fetch = asyncio.ensure_future(_next_page(pages))
+            if not page:
+                continue
+            if keys is None:
+                norm._set_projections(name)
+                if norm.collect_relations:
+                    norm.relations = RelationIndex(name)
+                keys = norm._entity_keys(name)
+            if executor:
+                await loop.run_in_executor(executor, _parse_page, norm, name, id_key, keys,
+                    page, new_data)
+            else:
+                # let the next fetch start before blocking the loop to normalize
+                await asyncio.sleep(0)
+                _parse_page(norm, name, id_key, keys, page, new_data)
+    finally:
+        fetch.cancel()
+    if keys is None:
+        return None
+    if executor:
+        return await loop.run_in_executor(executor, norm._post_process, new_data)
+    return norm._post_process(new_data)
@@ -1,7 +1,23 @@
 #!/usr/bin/python
 
+import copy
+import json
+import sys
+import threading
 import unittest
-from norm import Normalize
+from norm import Normalize, NormalizePlan, ColumnTable, NormalizedStore, NormalizeBatch, NormalizedResult, RelationIndex, load_schema, iter_json, normalize_stream, write_json
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+try:
+    import asyncio
+    from concurrent.futures import ThreadPoolExecutor
+    from norm_async import parse_pages
+except (ImportError, SyntaxError):
+    parse_pages = None
 
 class TestNormalizeBase(unittest.TestCase):
 
@@ -35,6 +51,75 @@ class TestNormalizeBase(unittest.TestCase):
         self.assertEqual(norm._get_entity_depth('bar', data), 2)
         data = {'id': 1, 'title': 'One', 'baz': [{'id': 2}, {'id': 1, 'bar': {'id': 1}}]}
         self.assertEqual(norm._get_entity_depth('bar', data), 2)
+        data = {'id': 1, 'tags': ['a', 'b'], 'baz': [{'id': 1, 'bar': {'id': 1}}]}
+        self.assertEqual(norm._get_entity_depth('bar', data), 2)
+
+    def test_deep_nesting(self):
+        data = leaf = {'id': 0}
+        for i in range(sys.getrecursionlimit() * 2):
+            leaf['baz'] = [{'id': i}] if i % 2 else {'id': i}
+            leaf = leaf['baz'] if i % 2 == 0 else leaf['baz'][0]
+        leaf['bar'] = {'id': 1}
+        norm = Normalize()
+        self.assertEqual(norm._get_entity_depth('bar', data), sys.getrecursionlimit() * 2 + 1)
+        self.assertEqual(norm._search_dict_all(data, 'bar'), [{'id': 1}])
+        self.assertTrue(norm._set_nested_id(data, 'bar', 3))
+        self.assertEqual(leaf['bar'], 3)
+
+    def test_entity_keys(self):
+        norm = Normalize()
+        norm.define_primary('foo')
+        norm.define_nested_entity('bar', 'baz')
+        norm.define_nested_entity('asdf', 'qwer', 'key')
+        self.assertEqual(norm._entity_keys('foo'), {'baz': ('bar', 'id'), 'qwer':
+            ('asdf', 'key')})
+        norm.define_nested_path('zxcv', 'baz.zxcv')
+        self.assertRaises(ValueError, norm._entity_keys, 'foo')
+        norm.set_entity_order(['bar'])
+        self.assertEqual(norm._entity_keys('foo'), {'baz': ('bar', 'id')})
+        norm.set_entity_order(['asdf', 'bar'])
+        self.assertEqual(norm._entity_keys('foo'), {'baz': ('bar', 'id'), 'qwer':
+            ('asdf', 'key')})
+
+    def test_extract(self):
+        data = {'id': 1, 'baz': [{'id': 2, 'qwer': {'id': 5}}, {'id': 3, 'qwer': [{'id': 6},
+            {'id': 7}]}], 'other': {'baz': {'id': 4}}}
+        new_data = {'results': [], 'entities': {'bar': {}, 'asdf': {}}}
+        norm = Normalize()
+        norm._extract(data, {'baz': ('bar', 'id'), 'qwer': ('asdf', 'id')}, new_data)
+        self.assertEqual(data, {'id': 1, 'baz': [2, 3], 'other': {'baz': [4]}})
+        self.assertEqual(new_data['entities'], {'bar': {2: {'id': 2, 'qwer': [5]}, 3: {'id': 3,
+            'qwer': [6, 7]}, 4: {'id': 4}}, 'asdf': {5: {'id': 5}, 6: {'id': 6}, 7: {'id': 7}}})
+
+    def test_extract_path(self):
+        data = {'id': 1, 'baz': [{'id': 2, 'qwer': {'id': 5}}, {'id': 3, 'qwer': [{'id': 6}]}],
+            'other': {'baz': {'id': 4}}, 'more': {'x': {'qwer': {'id': 8}}}}
+        new_data = {'results': [], 'entities': {'bar': {}, 'asdf': {}}}
+        norm = Normalize()
+        norm.define_primary('foo')
+        norm.define_nested_path('bar', 'baz')
+        norm.define_nested_path('asdf', 'baz.qwer')
+        norm.define_nested_path('zxcv', 'more.*.qwer')
+        norm.set_entity_order(['asdf', 'bar'])
+        norm._extract(data, norm._entity_keys('foo'), new_data)
+        self.assertEqual(data, {'id': 1, 'baz': [2, 3], 'other': {'baz': {'id': 4}}, 'more':
+            {'x': {'qwer': {'id': 8}}}})
+        self.assertEqual(new_data['entities'], {'bar': {2: {'id': 2, 'qwer': [5]}, 3: {'id': 3,
+            'qwer': [6]}}, 'asdf': {5: {'id': 5}, 6: {'id': 6}}})
+        new_data['entities']['zxcv'] = {}
+        norm.set_entity_order(['zxcv'])
+        norm._extract(data, norm._entity_keys('foo'), new_data)
+        self.assertEqual(data['more'], {'x': {'qwer': [8]}})
+
+        norm = Normalize()
+        norm.define_primary('foo')
+        norm.define_nested_path('x', 'a.*.c')
+        norm.define_nested_path('y', 'a.b.d')
+        new_data = {'results': [], 'entities': {'x': {}, 'y': {}}}
+        data = {'id': 1, 'a': {'b': {'c': {'id': 1}, 'd': {'id': 2}}, 'e': {'c': {'id': 3}}}}
+        norm._extract(data, norm._entity_keys('foo'), new_data)
+        self.assertEqual(new_data['entities'], {'x': {1: {'id': 1}, 3: {'id': 3}}, 'y': {2:
+            {'id': 2}}})
 
     def test_get_entity_order(self):
         data = {'id': 1, 'title': 'One', 'baz': {'id': 1}}
@@ -72,6 +157,36 @@ class TestNormalizeBase(unittest.TestCase):
         self.assertEqual(norm._process_data_changes('foo', data), {'baz':
             {'id': 1}, 'id': 1})
 
+    def test_set_projections(self):
+        norm = Normalize()
+        norm.define_primary('foo')
+        norm.define_nested_entity('bar', 'baz', 'key')
+        norm.remove_flds('foo', 'title')
+        norm.keep_flds('bar', 'name')
+        norm.rename_flds('bar', 'name', 'label')
+        norm._set_projections('foo')
+        self.assertEqual(sorted(norm.projections), ['bar', 'foo'])
+        self.assertEqual(norm.projections['bar'].keep, frozenset(['name', 'key']))
+        row = {'key': 1, 'name': 'One', 'size': 2}
+        self.assertEqual(norm.projections['bar'].drop(row, True), {'key': 1, 'name': 'One'})
+        self.assertEqual(row, {'key': 1, 'name': 'One', 'size': 2})
+        norm.projections['bar'].drop(row, False)
+        self.assertEqual(norm.projections['bar'].rename_flds(row), {'key': 1, 'label': 'One'})
+
+    def test_process_new_keys(self):
+        data = {'results': [1, 2, 3], 'entities': {'users': {1: {'id': 1, 'address': [2, 6]},
+            2: {'id': 2, 'address': 2}, 3: {'id': 3}}, 'addresses': {2: {'id': 2}, 6: {'id': 6},
+            7: {'id': 7}}}}
+        norm = Normalize()
+        norm.add_one_to_many_key('user_ids', 'address', 'addresses', 'users')
+        norm.add_one_to_many_key('same_ids', 'id', 'users', 'users')
+        self.assertEqual(norm._index_new_keys(data), {'users': {'address': {2: [1, 2], 6: [1]},
+            'id': {1: [1], 2: [2], 3: [3]}}})
+        data = norm._process_new_keys(data)
+        self.assertEqual(data['entities']['addresses'], {2: {'id': 2, 'user_ids': [1, 2]}, 6:
+            {'id': 6, 'user_ids': [1]}, 7: {'id': 7, 'user_ids': []}})
+        self.assertEqual(data['entities']['users'][3], {'id': 3, 'same_ids': [3]})
+
 
 class TestNormalize(unittest.TestCase):
 
@@ -104,6 +219,120 @@ class TestNormalize(unittest.TestCase):
         self.assertEqual(norm.entities, {'foo': {'entities': {'bar': {
             'id': 'id', 'key': 'foo'}, 'name': {'id': 'id', 'key': 'key'}}, 'id': 'id'}})
 
+    def test_define_nested_path(self):
+        norm = Normalize()
+        self.assertRaises(ValueError, norm.define_nested_path, 'foo', 'bar')
+        norm.define_primary('foo')
+        norm.define_nested_path('bar', 'baz.qwer')
+        self.assertEqual(norm.entities, {'foo': {'entities': {'bar': {
+            'id': 'id', 'key': 'qwer', 'path': ('baz', 'qwer')}}, 'id': 'id'}})
+        self.assertRaises(ValueError, norm.define_nested_path, 'bar', 'baz..qwer')
+
+    def test_parse_paths(self):
+        data = [{'id': 1, 'author': {'id': 2, 'address': {'id': 3}}, 'meta': {'address':
+            {'id': 4}}}, {'id': 2, 'author': [{'id': 5, 'address': [{'id': 6}]}]}]
+        norm = Normalize()
+        norm.define_primary('articles')
+        norm.define_nested_path('users', 'author')
+        norm.define_nested_path('addresses', 'author.address')
+        norm.set_entity_order(['addresses', 'users'])
+        self.assertEqual(norm.parse(data), {'entities': {'articles': {1: {'id': 1, 'author': [2],
+            'meta': {'address': {'id': 4}}}, 2: {'id': 2, 'author': [5]}}, 'users': {2: {'id': 2,
+            'address': [3]}, 5: {'id': 5, 'address': [6]}}, 'addresses': {3: {'id': 3}, 6:
+            {'id': 6}}}, 'results': [1, 2]})
+
+    def test_parse_projections(self):
+        data = [{'id': 1, 'title': 'One', 'baz': [{'id': 2, 'name': 'Two', 'big': [1, 2],
+            'qwer': {'id': 3, 'name': 'Three'}}]}]
+        norm = Normalize()
+        norm.define_primary('foo')
+        norm.define_nested_entity('bar', 'baz')
+        norm.define_nested_entity('asdf', 'qwer')
+        norm.set_entity_order(['asdf', 'bar'])
+        norm.rename_flds('foo', 'title', 'heading')
+        norm.keep_flds('bar', 'qwer')
+        norm.rename_flds('bar', 'qwer', 'asdf_ids')
+        norm.remove_flds('asdf', 'name')
+        norm.set_preserve_input()
+        self.assertEqual(norm.parse(data), {'entities': {'foo': {1: {'id': 1, 'heading': 'One',
+            'baz': [2]}}, 'bar': {2: {'id': 2, 'asdf_ids': [3]}}, 'asdf': {3: {'id': 3}}},
+            'results': [1]})
+        self.assertEqual(data[0]['baz'][0]['big'], [1, 2])
+        norm.keep_flds('bar', 'name')
+        self.assertEqual(norm.compile().parse(data)['entities']['bar'], {2: {'id': 2, 'name': 'Two',
+            'asdf_ids': [3]}})
+
+        norm = Normalize()
+        norm.define_primary('foo')
+        norm.define_nested_entity('bar', 'baz')
+        norm.remove_flds('foo', 'baz')
+        norm.set_preserve_input()
+        data = [{'id': 1, 'baz': {'id': 7}}]
+        self.assertEqual(norm.parse(data), {'entities': {'foo': {1: {'id': 1}}, 'bar': {7:
+            {'id': 7}}}, 'results': [1]})
+        self.assertEqual(data, [{'id': 1, 'baz': {'id': 7}}])
+
+    def test_denormalize(self):
+        data = [{'id': 1, 'title': 'One', 'baz': {'id': 1, 'qwer': [{'id': 5, 'name': 'Five'}]},
+            'meta': {'baz': {'id': 2}}}, {'id': 2, 'baz': [{'id': 1, 'qwer': [{'id': 5, 'name':
+            'Five'}]}], 'tags': [1, {'baz': {'id': 2}}]}]
+        norm = Normalize()
+        norm.define_primary('foo')
+        norm.define_nested_entity('bar', 'baz')
+        norm.define_nested_entity('asdf', 'qwer')
+        norm.rename_flds('foo', 'title', 'heading')
+        norm.rename_flds('bar', 'qwer', 'asdf_ids')
+        res = norm.parse(copy.deepcopy(data))
+        rows = norm.denormalize(res)
+        self.assertEqual(rows, [{'id': 1, 'title': 'One', 'baz': [{'id': 1, 'qwer': [{'id': 5,
+            'name': 'Five'}]}], 'meta': {'baz': [{'id': 2}]}}, {'id': 2, 'baz': [{'id': 1, 'qwer':
+            [{'id': 5, 'name': 'Five'}]}], 'tags': [1, {'baz': [{'id': 2}]}]}])
+        self.assertTrue(rows[0]['baz'][0] is rows[1]['baz'][0])
+        self.assertEqual(res['entities']['bar'][1], {'id': 1, 'asdf_ids': [5]})
+        self.assertEqual(norm.denormalize(res, 1)[1]['baz'], [{'id': 1, 'qwer': [5]}])
+        self.assertEqual(norm.denormalize(res, 0)[1]['baz'], [1])
+
+        norm = Normalize()
+        norm.define_primary('foo')
+        norm.define_nested_entity('bar', 'friend')
+        norm.swap_primary('bar')
+        res = norm.parse([{'id': 1, 'friend': {'id': 1, 'friend': {'id': 2, 'friend': {'id':
+            1}}}}])
+        self.assertEqual(norm.denormalize(res), [{'id': 1, 'friend': [{'id': 2, 'friend': [1]}]},
+            {'id': 2, 'friend': [{'id': 1, 'friend': [2]}]}])
+
+        data = [{'id': 1, 'author': {'id': 1, 'address': {'id': 1, 'city': 'home'}}, 'org': {'id':
+            7, 'address': {'id': 1, 'city': 'office'}}, 'meta': {'address': [1]}}]
+        norm = Normalize()
+        norm.define_primary('articles')
+        norm.define_nested_path('users', 'author')
+        norm.define_nested_path('user_addresses', 'author.address')
+        norm.define_nested_path('orgs', 'org')
+        norm.define_nested_path('org_addresses', 'org.address')
+        res = norm.parse(copy.deepcopy(data))
+        self.assertEqual(norm.denormalize(res), [{'id': 1, 'author': [{'id': 1, 'address': [{'id':
+            1, 'city': 'home'}]}], 'org': [{'id': 7, 'address': [{'id': 1, 'city': 'office'}]}],
+            'meta': {'address': [1]}}])
+        self.assertEqual(norm.denormalize(res, lazy=True)[0]['org'][0]['address'][0]['city'],
+            'office')
+
+    def test_denormalize_lazy(self):
+        norm = Normalize()
+        norm.define_primary('foo')
+        norm.define_nested_entity('bar', 'baz')
+        norm.define_nested_entity('asdf', 'qwer')
+        norm.set_columnar()
+        res = norm.parse([{'id': 1, 'baz': {'id': 1, 'qwer': {'id': 5}}, 'meta': {'size': 2}},
+            {'id': 2, 'baz': {'id': 1, 'qwer': {'id': 5}}}])
+        rows = norm.denormalize(res, lazy=True)
+        self.assertEqual(rows[0].cache, {})
+        self.assertEqual(rows[0]['baz'][0]['qwer'][0]['id'], 5)
+        self.assertTrue(rows[0]['baz'][0] is rows[1]['baz'][0])
+        self.assertEqual(rows[0]['meta']['size'], 2)
+        self.assertEqual(sorted(rows[0]), ['baz', 'id', 'meta'])
+        self.assertEqual(rows[1].get('title'), None)
+        self.assertEqual(rows, norm.denormalize(res))
+
     def test_swap_failure(self):
         data = [{'id': 1, 'title': 'One', 'baz': [{'id': 2}, {'id': 1, 'bar': {'id': 1}}]}]
         norm = Normalize()
@@ -162,9 +391,10 @@ class TestNormalize(unittest.TestCase):
         norm.define_primary('foo')
         norm.define_nested_entity('test', 'baz')
         norm.swap_primary('test')
-        self.assertEqual(norm.parse(data), {'entities': {'test': {1: {'bar': {'id': 1},
-            'id': 1}, 2: {'id': 2}}, 'foo': {1: {'baz': [2, 1], 'id': 1, 'title': 'One'}}},
-            'results': [1,2]})
+        res = norm.parse(data)
+        self.assertEqual(sorted(res.pop('results')), [1, 2])
+        self.assertEqual(res, {'entities': {'test': {1: {'bar': {'id': 1}, 'id': 1}, 2: {'id':
+            2}}, 'foo': {1: {'baz': [2, 1], 'id': 1, 'title': 'One'}}}})
 
         data = [{'id': 1, 'title': 'One', 'baz': [{'id': 2}, {'id': 1, 'bar': {'id': 1}}]}]
         norm = Normalize()
@@ -172,9 +402,11 @@ class TestNormalize(unittest.TestCase):
         norm.define_nested_entity('test', 'baz')
         norm.swap_primary('test')
         norm.add_one_to_many_key('foo_ids', 'id', 'test', 'foo')
-        self.assertEqual(norm.parse(data), {'entities': {'test': {1: {'foo_ids': [1], 'bar':
-            {'id': 1}, 'id': 1}, 2: {'foo_ids': [], 'id': 2}}, 'foo': {1: {'baz': [2, 1],
-            'id': 1, 'title': 'One'}}}, 'results': [1, 2]})
+        res = norm.parse(data)
+        self.assertEqual(sorted(res.pop('results')), [1, 2])
+        self.assertEqual(res, {'entities': {'test': {1: {'foo_ids': [1], 'bar': {'id': 1}, 'id':
+            1}, 2: {'foo_ids': [], 'id': 2}}, 'foo': {1: {'baz': [2, 1], 'id': 1, 'title':
+            'One'}}}})
 
         data = [{'id': 1, 'title': 'One', 'baz': [{'id': 1, 'bar': {'id': 1}}]}]
         norm = Normalize()
@@ -184,6 +416,214 @@ class TestNormalize(unittest.TestCase):
             'id': 1}}, 'foo': {1: {'baz': [1], 'id': 1, 'title': 'One'}}},
             'results': [1]})
 
+        data = [{'id': 1, 'baz': {'id': 1}}, {'id': 2, 'baz': [{'id': 2, 'bar': {'id': 1}},
+            {'id': 3, 'bar': [{'id': 2}, {'id': 3}]}]}]
+        norm = Normalize()
+        norm.define_primary('foo')
+        norm.define_nested_entity('test', 'baz')
+        norm.define_nested_entity('other', 'bar')
+        self.assertEqual(norm.parse(data), {'entities': {'test': {1: {'id': 1}, 2: {'bar': [1],
+            'id': 2}, 3: {'bar': [2, 3], 'id': 3}}, 'other': {1: {'id': 1}, 2: {'id': 2}, 3:
+            {'id': 3}}, 'foo': {1: {'baz': [1], 'id': 1}, 2: {'baz': [2, 3], 'id': 2}}},
+            'results': [1, 2]})
+        self.assertEqual(norm.entity_order, [])
+
+    def test_parse_deep(self):
+        depth = sys.getrecursionlimit() * 2
+        data = leaf = {'id': 0}
+        for i in range(1, depth):
+            leaf['baz' if i % 2 else 'meta'] = [{'id': i}] if i % 2 else {'id': i}
+            leaf = leaf['baz'][0] if i % 2 else leaf['meta']
+        leaf['qwer'] = {'id': 1}
+        norm = Normalize()
+        norm.define_primary('foo')
+        norm.define_nested_entity('bar', 'baz')
+        norm.define_nested_entity('asdf', 'qwer')
+        norm.set_preserve_input()
+        norm.set_stats()
+        res = norm.parse([data])
+        self.assertEqual(res['entities']['asdf'], {1: {'id': 1}})
+        self.assertEqual(sorted(res['entities']['bar']), list(range(1, depth, 2)))
+        self.assertEqual(res['entities']['foo'][0], {'id': 0, 'baz': [1]})
+        self.assertEqual(norm.stats['max_depth'], depth + 1)
+        self.assertEqual(leaf['qwer'], {'id': 1})
+
+    def test_parse_iter(self):
+        data = ({'id': i, 'baz': {'id': i % 2}} for i in range(3))
+        norm = Normalize()
+        norm.define_primary('foo')
+        norm.define_nested_entity('bar', 'baz')
+        norm.rename_flds('foo', 'baz', 'bar_ids')
+        self.assertEqual(list(norm.parse_iter(data, 2)), [{'entities': {'foo': {0: {'id': 0,
+            'bar_ids': [0]}, 1: {'id': 1, 'bar_ids': [1]}}, 'bar': {0: {'id': 0}, 1: {'id': 1}}},
+            'results': [0, 1]}, {'entities': {'foo': {2: {'id': 2, 'bar_ids': [0]}}, 'bar': {}},
+            'results': [2]}])
+        self.assertEqual(list(norm.parse_iter([])), [])
+
+        norm.swap_primary('bar')
+        self.assertEqual([v['results'] for v in norm.parse_iter([{'id': 1, 'baz': {'id': 3}},
+            {'id': 2, 'baz': {'id': 3}}], 1)], [[3], []])
+        self.assertRaises(ValueError, norm.parse_iter, [], 0)
+        norm.add_one_to_many_key('foo_ids', 'baz', 'bar', 'foo')
+        self.assertRaises(ValueError, norm.parse_iter, [])
+
+    def test_preserve_input(self):
+        data = [{'id': 1, 'title': 'One', 'meta': {'x': 1}, 'baz': [{'id': 2}, {'id': 1, 'bar':
+            {'id': 1}}]}]
+        norm = Normalize()
+        norm.define_primary('foo')
+        norm.define_nested_entity('test', 'baz')
+        norm.define_nested_entity('other', 'bar')
+        norm.rename_flds('foo', 'title', 'heading')
+        norm.add_one_to_many_key('foo_ids', 'baz', 'test', 'foo')
+        norm.set_preserve_input()
+        res = norm.parse(data)
+        self.assertEqual(data, [{'id': 1, 'title': 'One', 'meta': {'x': 1}, 'baz': [{'id': 2},
+            {'id': 1, 'bar': {'id': 1}}]}])
+        self.assertEqual(res, {'entities': {'test': {1: {'bar': [1], 'id': 1, 'foo_ids': [1]}, 2:
+            {'id': 2, 'foo_ids': [1]}}, 'other': {1: {'id': 1}}, 'foo': {1: {'baz': [2, 1], 'id':
+            1, 'heading': 'One', 'meta': {'x': 1}}}}, 'results': [1]})
+        self.assertTrue(res['entities']['foo'][1]['meta'] is data[0]['meta'])
+        self.assertFalse(res['entities']['other'][1] is data[0]['baz'][1]['bar'])
+
+    def test_dedupe(self):
+        data = [{'id': 1, 'baz': {'id': 1, 'a': 1, 'qwer': {'id': 1}}}, {'id': 2, 'baz': {'id': 1,
+            'b': 2, 'qwer': {'id': 2}}}]
+        norm = Normalize()
+        norm.define_primary('foo')
+        norm.define_nested_entity('bar', 'baz')
+        norm.define_nested_entity('asdf', 'qwer')
+        norm.set_dedupe('trust')
+        res = norm.parse([dict(v) for v in data])
+        self.assertEqual(res['entities']['bar'], {1: {'id': 1, 'a': 1, 'qwer': [1]}})
+        self.assertEqual(res['entities']['asdf'], {1: {'id': 1}})
+        self.assertEqual(res['entities']['foo'][2], {'id': 2, 'baz': [1]})
+
+        norm.set_dedupe('merge')
+        self.assertEqual(norm.parse([dict(v) for v in data])['entities']['bar'], {1: {'id': 1,
+            'a': 1, 'b': 2, 'qwer': [2]}})
+        norm.set_preserve_input()
+        data = [{'id': 1, 'baz': {'id': 1, 'n': {'x': 1}}}, {'id': 2, 'baz': {'id': 1, 'n': {'y':
+            2}}}, {'id': 3, 'baz': {'id': 1, 'n': {'z': 3}}}]
+        self.assertEqual(norm.parse(data)['entities']['bar'], {1: {'id': 1, 'n': {'x': 1, 'y': 2,
+            'z': 3}}})
+        self.assertEqual(data, [{'id': 1, 'baz': {'id': 1, 'n': {'x': 1}}}, {'id': 2, 'baz': {'id':
+            1, 'n': {'y': 2}}}, {'id': 3, 'baz': {'id': 1, 'n': {'z': 3}}}])
+        norm.set_preserve_input(False)
+        norm.set_dedupe('compare')
+        self.assertRaises(ValueError, norm.parse, [dict(v) for v in data])
+        self.assertEqual(norm.parse([{'id': 1, 'baz': {'id': 1}}, {'id': 2, 'baz': {'id': 1}}])
+            ['entities']['bar'], {1: {'id': 1}})
+
+    def test_columnar(self):
+        norm = Normalize()
+        norm.define_primary('foo')
+        norm.define_nested_entity('bar', 'baz')
+        norm.swap_primary('bar')
+        norm.set_columnar()
+        res = norm.parse([{'id': 1, 'baz': {'id': 2, 'name': 'Two'}}])
+        self.assertTrue(isinstance(res['entities']['bar'], ColumnTable))
+        self.assertEqual(res['results'], [2])
+        self.assertEqual(res['entities']['bar'][2]['name'], 'Two')
+        self.assertEqual(res['entities']['foo'].to_dict(), {1: {'id': 1, 'baz': [2]}})
+        chunks = list(norm.parse_iter([{'id': 1, 'baz': {'id': 2}}]))
+        self.assertEqual(chunks[0]['entities']['bar'].to_dict(), {2: {'id': 2}})
+
+    def test_stats(self):
+        data = [{'id': 1, 'baz': [{'id': 1, 'qwer': {'id': 2}}, {'id': 2}]}, {'id': 2, 'baz': {'id':
+            1}, 'meta': {'tags': [1]}}]
+        norm = Normalize()
+        norm.define_primary('foo')
+        norm.define_nested_entity('bar', 'baz')
+        norm.define_nested_entity('asdf', 'qwer')
+        stats = []
+        norm.add_stats_hook(stats.append)
+        res = norm.parse(data)
+        self.assertEqual(res['entities']['foo'][2], {'id': 2, 'baz': [1], 'meta': {'tags': [1]}})
+        self.assertEqual(stats, [norm.stats])
+        self.assertEqual(norm.stats['nodes'], 8)
+        self.assertEqual(norm.stats['max_depth'], 3)
+        self.assertEqual(norm.stats['entities'], {'bar': {'extracted': 3, 'overwritten': 1,
+            'skipped': 0}, 'asdf': {'extracted': 1, 'overwritten': 0, 'skipped': 0}})
+        self.assertEqual(sorted(norm.stats['time']), ['columns', 'extract', 'field_changes',
+            'new_keys', 'order', 'primary_swap', 'total'])
+        self.assertEqual(sorted(norm.__dict__), sorted(Normalize().__dict__))
+
+        norm.set_dedupe()
+        norm.parse([{'id': 1, 'baz': {'id': 1}}, {'id': 2, 'baz': {'id': 1}}])
+        self.assertEqual(norm.stats['entities']['bar'], {'extracted': 1, 'overwritten': 0,
+            'skipped': 1})
+        self.assertRaises(ValueError, norm.parse_iter, [{'id': 1}])
+        self.assertRaises(ValueError, NormalizedStore(norm).merge, [{'id': 1}])
+        norm.set_stats(False)
+        norm.parse([{'id': 1}])
+        self.assertEqual(len(stats), 2)
+
+    def test_relations(self):
+        data = [{'id': 1, 'author': {'id': 1, 'address': [{'id': 5}, {'id': 6}]}}, {'id': 2,
+            'author': [{'id': 1, 'address': {'id': 5}}, {'id': 2, 'address': {'id': 5}}]}]
+        norm = Normalize()
+        norm.define_primary('articles')
+        norm.define_nested_entity('users', 'author')
+        norm.define_nested_entity('addresses', 'address')
+        norm.set_relations()
+        norm.parse(copy.deepcopy(data))
+        relations = norm.relations
+        self.assertTrue(isinstance(relations, RelationIndex))
+        self.assertEqual(sorted(relations.parents('addresses', 5, 'users')), [1, 2])
+        self.assertEqual(sorted(relations.parents('users', 1, 'articles')), [1, 2])
+        self.assertEqual(relations.parents('users', 2), [('articles', 2)])
+        self.assertEqual(sorted(relations.children('users', 1, 'addresses')), [5, 6])
+        self.assertEqual(sorted(relations.records('addresses', 5)), [1, 2])
+        self.assertEqual(relations.records('addresses', 6), [1])
+        self.assertEqual(relations.parents('addresses', 7), [])
+
+        norm.set_dedupe()
+        norm.parse(copy.deepcopy(data))
+        self.assertEqual(sorted(norm.relations.parents('users', 1, 'articles')), [1, 2])
+        self.assertEqual(sorted(norm.relations.records('addresses', 5)), [1, 2])
+        norm.parse([{'id': 1, 'author': {'id': 1, 'address': {'id': 5}}}, {'id': 2, 'author':
+            {'id': 1, 'address': {'id': 5}}}])
+        self.assertEqual(sorted(norm.relations.records('addresses', 5)), [1, 2])
+        self.assertEqual(norm.relations.parents('addresses', 5), [('users', 1)])
+        list(norm.parse_iter(copy.deepcopy(data), 1))
+        self.assertEqual(sorted(norm.relations.children('articles', 2, 'users')), [1, 2])
+        self.assertRaises(ValueError, norm.parse_parallel, data)
+        norm.set_relations(False)
+        norm.parse(copy.deepcopy(data))
+        self.assertEqual(norm.relations, None)
+
+    def test_parse_parallel(self):
+        norm = Normalize()
+        norm.define_primary('foo')
+        norm.define_nested_entity('bar', 'baz')
+        norm.swap_primary('bar')
+        norm.add_one_to_many_key('foo_ids', 'baz', 'bar', 'foo')
+        data = [{'id': i, 'baz': [{'id': i % 3}, {'id': i % 5}]} for i in range(20)]
+        self.assertEqual(norm.parse_parallel([dict(v) for v in data], 2, shard_size=3),
+            norm.parse([dict(v) for v in data]))
+        self.assertEqual(norm.parse_parallel([]), None)
+        self.assertRaises(ValueError, norm.parse_parallel, data, 2, 'asdf')
+
+        norm = Normalize()
+        norm.define_primary('foo')
+        norm.define_nested_entity('bar', 'baz')
+        data = [{'id': 1, 'baz': {'id': 1, 'a': 1, 'n': {'x': 1}}}, {'id': 2, 'baz': {'id': 1,
+            'b': 2, 'n': {'y': 2}}}, {'id': 1, 'c': 3}]
+        for shard_size in (None, 1, 2, 3):
+            res = norm.parse_parallel(copy.deepcopy(data), 2, 'last', shard_size)
+            self.assertEqual(res['entities']['bar'], {1: {'id': 1, 'b': 2, 'n': {'y': 2}}})
+            self.assertEqual(res['entities']['foo'][1], {'id': 1, 'c': 3})
+            res = norm.parse_parallel(copy.deepcopy(data), 2, 'first', shard_size)
+            self.assertEqual(res['entities']['bar'], {1: {'id': 1, 'a': 1, 'n': {'x': 1}}})
+            self.assertEqual(res['entities']['foo'][1], {'id': 1, 'baz': [1]})
+            res = norm.parse_parallel(copy.deepcopy(data), 2, 'merge', shard_size)
+            self.assertEqual(res['entities']['bar'], {1: {'id': 1, 'a': 1, 'b': 2, 'n': {'x': 1,
+                'y': 2}}})
+            self.assertEqual(res['entities']['foo'][1], {'id': 1, 'baz': [1], 'c': 3})
+        norm.add_stats_hook(lambda stats: None)
+        self.assertRaises(ValueError, norm.parse_parallel, data, 2)
+
     def test_rename_flds(self):
         norm = Normalize()
         norm.define_primary('foo')
@@ -201,6 +641,12 @@ class TestNormalize(unittest.TestCase):
         norm.add_one_to_many_key('new_key', 'to_key', 'to', 'from')
         self.assertEqual(norm.new_keys, [{'name': 'new_key', 'to_key': 'to_key', 'to': 'to', 'from': 'from'}])
 
+    def test_keep_flds(self):
+        norm = Normalize()
+        norm.keep_flds('foo', 'title')
+        norm.keep_flds('foo', 'name')
+        self.assertEqual(norm.keep_fldvals, {'foo': ['title', 'name']})
+
     def test_remove_flds(self):
         norm = Normalize()
         norm.define_primary('foo')
@@ -213,11 +659,496 @@ class TestNormalize(unittest.TestCase):
         norm.set_entity_order(('foo', 'bar'))
         self.assertEqual(norm.entity_order, ('foo', 'bar'))
 
+    def test_set_preserve_input(self):
+        norm = Normalize()
+        self.assertEqual(norm.preserve_input, False)
+        norm.set_preserve_input()
+        self.assertEqual(norm.preserve_input, True)
+
+    def test_set_dedupe(self):
+        norm = Normalize()
+        self.assertEqual(norm.dedupe, None)
+        norm.set_dedupe()
+        self.assertEqual(norm.dedupe, 'trust')
+        norm.set_dedupe(None)
+        self.assertEqual(norm.dedupe, None)
+        self.assertRaises(ValueError, norm.set_dedupe, 'asdf')
+
+    def test_set_columnar(self):
+        norm = Normalize()
+        self.assertEqual(norm.columnar, False)
+        norm.set_columnar()
+        self.assertEqual(norm.columnar, True)
+
+    def test_set_lazy(self):
+        norm = Normalize()
+        norm.set_lazy()
+        self.assertTrue(norm.lazy)
+        norm.set_lazy(False)
+        self.assertFalse(norm.lazy)
+
+    def test_set_stats(self):
+        norm = Normalize()
+        self.assertEqual(norm.collect_stats, False)
+        norm.set_stats()
+        self.assertEqual(norm.collect_stats, True)
+        norm.set_stats(False)
+        norm.add_stats_hook(len)
+        self.assertEqual(norm.stats_hooks, [len])
+        self.assertEqual(norm.collect_stats, True)
+
     def test_ignore_keys(self):
         norm = Normalize()
         norm.set_ignore_keys(['test'])
         self.assertEqual(norm.ignore_flds, ['test'])
 
 
+class TestNormalizePlan(unittest.TestCase):
+
+    def test_compile(self):
+        norm = Normalize()
+        norm.define_primary('foo')
+        norm.define_nested_entity('bar', 'baz')
+        norm.define_nested_entity('asdf', 'qwer')
+        norm.rename_flds('foo', 'title', 'heading')
+        plan = norm.compile()
+        self.assertTrue(isinstance(plan, NormalizePlan))
+        self.assertEqual(plan.entity_order, ('bar', 'asdf') if list(norm.entities['foo']
+            ['entities'])[0] == 'bar' else ('asdf', 'bar'))
+        self.assertEqual(plan.keys, {'baz': ('bar', 'id'), 'qwer': ('asdf', 'id')})
+        self.assertEqual(norm.entity_order, [])
+        norm.rename_flds('foo', 'heading', 'asdf')
+        self.assertEqual(plan.rename_fldvals, {'foo': (('title', 'heading'),)})
+        self.assertRaises(AttributeError, setattr, plan, 'dedupe', 'trust')
+        self.assertRaises(ValueError, Normalize().compile)
+        norm.swap_primary('qwer')
+        self.assertRaises(ValueError, norm.compile)
+
+    def test_parse(self):
+        data = [{'id': 1, 'title': 'One', 'baz': [{'id': 1, 'qwer': {'id': 2}}, {'id': 2}]}, {'id':
+            2, 'baz': {'id': 1}}]
+        norm = Normalize()
+        norm.define_primary('foo')
+        norm.define_nested_entity('bar', 'baz')
+        norm.define_nested_entity('asdf', 'qwer')
+        norm.rename_flds('foo', 'title', 'heading')
+        norm.add_one_to_many_key('foo_ids', 'baz', 'bar', 'foo')
+        plan = norm.compile()
+        expected = norm.parse(copy.deepcopy(data))
+        self.assertEqual(plan.parse(copy.deepcopy(data)), expected)
+        self.assertEqual(plan.parse([]), None)
+        self.assertRaises(ValueError, plan.parse_iter, data)
+        norm = Normalize()
+        norm.define_primary('foo')
+        self.assertEqual(list(norm.compile().parse_iter([{'id': 1}])), [{'entities': {'foo': {1:
+            {'id': 1}}}, 'results': [1]}])
+
+    def test_threads(self):
+        norm = Normalize()
+        norm.define_primary('foo')
+        norm.define_nested_entity('bar', 'baz')
+        norm.define_nested_entity('asdf', 'qwer')
+        norm.add_one_to_many_key('foo_ids', 'baz', 'bar', 'foo')
+        plan = norm.compile()
+        data = [{'id': i, 'baz': [{'id': i % 7, 'qwer': {'id': i % 3}}]} for i in range(200)]
+        expected = plan.parse(copy.deepcopy(data))
+        res = []
+
+        def run():
+            for i in range(5):
+                res.append(plan.parse(copy.deepcopy(data)))
+        threads = [threading.Thread(target=run) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(res, [expected] * 20)
+
+
+class TestNormalizedResult(unittest.TestCase):
+
+    def test_lazy(self):
+        data = [{'id': 1, 'baz': [{'id': 1, 'qwer': {'id': 5}}, {'id': 2}]}, {'id': 2, 'baz':
+            {'id': 1, 'qwer': {'id': 5}}}]
+        norm = Normalize()
+        norm.define_primary('foo')
+        norm.define_nested_entity('bar', 'baz')
+        norm.define_nested_entity('asdf', 'qwer')
+        norm.add_one_to_many_key('foo_ids', 'baz', 'bar', 'foo')
+        expected = norm.parse(copy.deepcopy(data))
+        norm.set_lazy()
+        res = norm.parse(copy.deepcopy(data))
+        self.assertTrue(isinstance(res, NormalizedResult))
+        norm.rename_flds('foo', 'baz', 'bar_ids')
+        self.assertEqual(res['results'], [1, 2])
+        self.assertEqual(res.rows, {})
+        self.assertEqual(res['entities']['asdf'], {5: {'id': 5}})
+        self.assertEqual(sorted(res.tables), ['asdf'])
+        self.assertEqual(sorted(res.rows), ['asdf'])
+        self.assertEqual(res['entities']['bar'], expected['entities']['bar'])
+        self.assertEqual(sorted(res.rows), ['asdf', 'bar', 'foo'])
+        self.assertEqual(sorted(res['entities']), ['asdf', 'bar', 'foo'])
+        self.assertEqual(res, expected)
+        self.assertRaises(KeyError, res['entities'].__getitem__, 'qwer')
+
+        swapped = Normalize()
+        swapped.define_primary('foo')
+        swapped.define_nested_entity('bar', 'baz')
+        swapped.swap_primary('bar')
+        swapped.set_columnar()
+        expected = swapped.parse(copy.deepcopy(data))
+        swapped.set_lazy()
+        res = swapped.parse(copy.deepcopy(data))
+        self.assertEqual(sorted(res['results']), [1, 2])
+        self.assertTrue(isinstance(res['entities']['bar'], ColumnTable))
+        self.assertEqual(res['entities']['bar'][1], expected['entities']['bar'][1])
+        self.assertRaises(ValueError, swapped.parse, [{'title': 'One'}])
+
+        res = norm.parse(copy.deepcopy(data))
+        self.assertEqual(res['entities']['foo'][2], {'id': 2, 'bar_ids': [1]})
+        self.assertEqual(res.index, None)
+        self.assertEqual(sorted(res.rows), ['foo'])
+
+        norm = Normalize()
+        norm.define_primary('foo')
+        norm.define_nested_entity('bar', 'baz')
+        norm.define_nested_entity('asdf', 'qwer')
+        norm.add_one_to_many_key('foo_ids', 'baz', 'bar', 'foo')
+        norm.set_lazy()
+        data = [{'id': 1, 'baz': {'id': 2, 'qwer': [{'id': 3}]}}]
+        res = norm.parse(data)
+        data.append({'id': 2})
+        self.assertEqual(res['entities']['bar'], {2: {'id': 2, 'qwer': [3], 'foo_ids': [1]}})
+        self.assertEqual(res['results'], [1])
+        self.assertEqual(data, [{'id': 1, 'baz': {'id': 2, 'qwer': [{'id': 3}]}}, {'id': 2}])
+        norm.set_stats()
+        self.assertRaises(ValueError, norm.parse, data)
+        norm.set_stats(False)
+        norm.set_relations()
+        self.assertRaises(ValueError, norm.parse, data)
+
+class TestColumnTable(unittest.TestCase):
+
+    def test_columns(self):
+        table = ColumnTable({1: {'id': 1, 'name': 'One', 'score': 1.5, 'ids': [1]}, 2: {'id': 2,
+            'score': 2.5, 'count': 3}})
+        self.assertEqual(table.columns['id'].typecode in ('q', 'l'), True)
+        self.assertEqual(table.columns['score'].typecode, 'd')
+        self.assertEqual(table.column('name'), ['One', None])
+        self.assertEqual(table.column('count'), [None, 3])
+        self.assertEqual(sorted(table), [1, 2])
+        self.assertEqual(len(table), 2)
+        self.assertTrue(2 in table)
+        self.assertFalse(3 in table)
+
+    def test_row_view(self):
+        rows = {1: {'id': 1, 'name': 'One', 'ids': [1]}, 2: {'id': 2, 'count': 3}}
+        table = ColumnTable(rows)
+        self.assertEqual(table[1]['name'], 'One')
+        self.assertEqual(table[2]['name'], None)
+        self.assertEqual(table[2]['count'], 3)
+        self.assertEqual(table[2].get('asdf', 5), 5)
+        self.assertTrue('count' in table[2])
+        self.assertFalse('count' in table[1])
+        self.assertEqual(sorted(table[1].keys()), ['id', 'ids', 'name'])
+        self.assertEqual(table[1], rows[1])
+        self.assertEqual(table.to_dict(), rows)
+        self.assertRaises(KeyError, table.__getitem__, 3)
+
+
+class TestNormalizedStore(unittest.TestCase):
+
+    def test_merge(self):
+        norm = Normalize()
+        norm.define_primary('foo')
+        norm.define_nested_entity('bar', 'baz')
+        norm.add_one_to_many_key('foo_ids', 'baz', 'bar', 'foo')
+        store = NormalizedStore(norm)
+        delta = store.merge([{'id': 1, 'baz': {'id': 1}}, {'id': 2, 'baz': {'id': 1}}])
+        self.assertEqual(delta['results'], [1, 2])
+        self.assertEqual(sorted(delta['added']['foo']), [1, 2])
+        self.assertEqual(delta['added']['bar'], [1])
+        self.assertEqual(delta['entities']['bar'], {1: {'id': 1, 'foo_ids': [1, 2]}})
+        self.assertEqual(delta['changed'], {})
+
+        delta = store.merge([{'id': 2, 'title': 'Two', 'baz': {'id': 3}}, {'id': 3}])
+        self.assertEqual(delta['results'], [3])
+        self.assertEqual(delta['added'], {'foo': [3], 'bar': [3]})
+        self.assertEqual(delta['changed'], {'foo': [2], 'bar': [1]})
+        self.assertEqual(delta['entities']['bar'], {1: {'id': 1, 'foo_ids': [1]}, 3: {'id': 3,
+            'foo_ids': [2]}})
+        self.assertEqual(store.data['results'], [1, 2, 3])
+
+        delta = store.merge([{'id': 3}])
+        self.assertEqual(delta, {'results': [], 'entities': {}, 'added': {}, 'changed': {},
+            'removed': {}})
+
+    def test_merge_unchanged(self):
+        norm = Normalize()
+        norm.define_primary('users')
+        norm.define_nested_entity('addresses', 'address')
+        norm.add_one_to_many_key('user_ids', 'address', 'addresses', 'users')
+        store = NormalizedStore(norm)
+        store.merge([{'id': 1, 'address': {'id': 9}}, {'id': 2, 'address': {'id': 9}}])
+        delta = store.merge([{'id': 1, 'address': {'id': 9}}])
+        self.assertEqual(delta, {'results': [], 'entities': {}, 'added': {}, 'changed': {},
+            'removed': {}})
+        self.assertEqual(store.data['entities']['addresses'][9]['user_ids'], [1, 2])
+        delta = store.merge([{'id': 1, 'address': [{'id': 9}, {'id': 8}]}])
+        self.assertEqual(delta['changed'], {'users': [1]})
+        self.assertEqual(delta['added'], {'addresses': [8]})
+        self.assertEqual(store.data['entities']['addresses'][9]['user_ids'], [1, 2])
+
+    def test_merge_removed(self):
+        norm = Normalize()
+        norm.define_primary('foo')
+        norm.define_nested_entity('bar', 'baz')
+        norm.add_one_to_many_key('foo_ids', 'baz', 'bar', 'foo')
+        store = NormalizedStore(norm)
+        store.merge([{'id': 1, 'baz': {'id': 1}}, {'id': 2, 'baz': {'id': 1}}])
+        delta = store.merge([], {'foo': [1, 5]})
+        self.assertEqual(delta['removed'], {'foo': [1]})
+        self.assertEqual(delta['changed'], {'bar': [1]})
+        self.assertEqual(store.data['results'], [2])
+        self.assertEqual(store.data['entities']['bar'], {1: {'id': 1, 'foo_ids': [2]}})
+
+    def test_swap_primary(self):
+        norm = Normalize()
+        norm.define_primary('foo')
+        norm.define_nested_entity('bar', 'baz')
+        norm.add_one_to_many_key('foo_ids', 'baz', 'bar', 'foo')
+        norm.swap_primary('bar')
+        store = NormalizedStore(norm)
+        self.assertEqual(sorted(store.merge([{'id': 1, 'baz': [{'id': 4}, {'id': 3}]}])
+            ['results']), [3, 4])
+        self.assertEqual(store.merge([{'id': 2, 'baz': {'id': 3}}])['results'], [])
+        norm.swap_primary('asdf')
+        self.assertRaises(ValueError, NormalizedStore, norm)
+
+class TestNormalizeBatch(unittest.TestCase):
+
+    def test_add_primary(self):
+        articles = Normalize()
+        articles.define_primary('articles')
+        articles.define_nested_entity('users', 'author')
+        comments = Normalize()
+        comments.define_primary('comments')
+        comments.define_nested_entity('users', 'user')
+        comments.define_nested_entity('articles', 'article')
+        comments.set_dedupe()
+        batch = NormalizeBatch()
+        batch.add_primary(articles)
+        batch.add_primary(comments, 'feedback')
+        self.assertEqual([v[0] for v in batch.members], ['articles', 'feedback'])
+        self.assertEqual(batch.entity_ids, {'articles': 'id', 'users': 'id', 'comments': 'id'})
+        self.assertRaises(ValueError, batch.add_primary, articles)
+        self.assertRaises(ValueError, batch.add_primary, Normalize())
+        devices = Normalize()
+        devices.define_primary('devices')
+        devices.define_nested_entity('users', 'owner', 'key')
+        self.assertRaises(ValueError, batch.add_primary, devices)
+
+    def test_parse(self):
+        articles = Normalize()
+        articles.define_primary('articles')
+        articles.define_nested_entity('users', 'author')
+        comments = Normalize()
+        comments.define_primary('comments')
+        comments.define_nested_entity('users', 'user')
+        comments.define_nested_entity('articles', 'article')
+        comments.set_dedupe()
+        batch = NormalizeBatch()
+        batch.add_primary(articles)
+        batch.add_primary(comments, 'feedback')
+        self.assertEqual(batch.parse({}), None)
+        self.assertRaises(ValueError, NormalizeBatch().parse, {'articles': []})
+        data = {'articles': [{'id': 1, 'author': {'id': 5, 'name': 'Dan'}}], 'feedback': [
+            {'id': 3, 'user': {'id': 5, 'name': 'Other'}, 'article': {'id': 2}},
+            {'id': 4, 'user': {'id': 6}}], 'cursor': 'next'}
+        self.assertEqual(batch.parse(data), {'results': {'articles': [1], 'feedback': [3, 4]},
+            'entities': {'articles': {1: {'id': 1, 'author': [5]}, 2: {'id': 2}}, 'users': {
+            5: {'id': 5, 'name': 'Dan'}, 6: {'id': 6}}, 'comments': {3: {'id': 3, 'user': [5],
+            'article': [2]}, 4: {'id': 4, 'user': [6]}}}})
+        self.assertEqual(batch.parse({'articles': [{'id': 1}]})['results'], {'articles': [1],
+            'feedback': []})
+
+    def test_parse_post_process(self):
+        articles = Normalize()
+        articles.define_primary('articles')
+        articles.define_nested_entity('users', 'author')
+        comments = Normalize()
+        comments.define_primary('comments')
+        comments.define_nested_entity('users', 'user')
+        comments.define_nested_entity('articles', 'article')
+        comments.set_dedupe()
+        batch = NormalizeBatch()
+        batch.add_primary(articles)
+        batch.add_primary(comments, 'feedback')
+        articles.add_one_to_many_key('comment_ids', 'article', 'articles', 'comments')
+        comments.swap_primary('users')
+        articles.set_columnar()
+        data = batch.parse({'articles': [{'id': 1, 'author': {'id': 5}}], 'feedback': [
+            {'id': 3, 'user': {'id': 6}, 'article': {'id': 1}}]})
+        self.assertEqual(data['results'], {'articles': [1], 'feedback': [6]})
+        self.assertTrue(isinstance(data['entities']['users'], ColumnTable))
+        self.assertEqual(data['entities']['articles'].to_dict(), {1: {'id': 1, 'author': [5],
+            'comment_ids': [3]}})
+        self.assertEqual(data['entities']['users'].to_dict(), {5: {'id': 5}, 6: {'id': 6}})
+        data = batch.parse({'articles': [{'id': 1, 'author': {'id': 5, 'name': 'Dan'}}],
+            'feedback': [{'id': 3, 'user': {'id': 5, 'name': 'Other'}}, {'id': 4, 'user': {'id':
+            6}}]})
+        self.assertEqual(sorted(data['results']['feedback']), [5, 6])
+        self.assertEqual(data['entities']['users'].to_dict(), {5: {'id': 5, 'name': 'Dan'}, 6:
+            {'id': 6}})
+        articles.set_stats()
+        self.assertRaises(ValueError, batch.parse, {'articles': [{'id': 1}]})
+
+
+class TestCommandLine(unittest.TestCase):
+
+    def test_load_schema(self):
+        norm = load_schema({'primary': 'foo', 'entities': [{'name': 'bar', 'key': 'baz'}, {'name':
+            'asdf', 'key': 'qwer', 'id': 'key'}], 'rename': {'foo': {'title': 'heading'}}, 'remove':
+            {'bar': ['name']}, 'ignore': ['meta'], 'swap_primary': 'bar', 'dedupe': 'merge',
+            'one_to_many': [{'name': 'foo_ids', 'to_key': 'id', 'to': 'bar', 'from': 'foo'}]})
+        self.assertEqual(norm.entities, {'foo': {'entities': {'bar': {'id': 'id', 'key': 'baz'},
+            'asdf': {'id': 'key', 'key': 'qwer'}}, 'id': 'id'}})
+        self.assertEqual(norm.rename_fldvals, {'foo': [('title', 'heading')]})
+        self.assertEqual(norm.remove_fldvals, {'bar': ['name']})
+        self.assertEqual(norm.ignore_flds, ['meta'])
+        self.assertEqual(norm.swap_primary_to, 'bar')
+        self.assertEqual(norm.dedupe, 'merge')
+        self.assertEqual(norm.new_keys, [{'name': 'foo_ids', 'to_key': 'id', 'to': 'bar', 'from':
+            'foo'}])
+        self.assertRaises(ValueError, load_schema, {})
+        norm = load_schema({'primary': 'foo', 'entities': [{'name': 'bar', 'path': 'baz.qwer'}],
+            'keep': {'bar': ['name']}})
+        self.assertEqual(norm.keep_fldvals, {'bar': ['name']})
+        self.assertEqual(norm.entities, {'foo': {'entities': {'bar': {'id': 'id', 'key': 'qwer',
+            'path': ('baz', 'qwer')}}, 'id': 'id'}})
+        batch = load_schema({'primaries': [{'primary': 'foo', 'entities': [{'name': 'bar',
+            'key': 'baz'}]}, {'primary': 'asdf', 'collection': 'qwer'}]})
+        self.assertTrue(isinstance(batch, NormalizeBatch))
+        self.assertEqual([v[0] for v in batch.members], ['foo', 'qwer'])
+
+    def test_iter_json(self):
+        rows = [{'id': 1, 'baz': [1, 2]}, {'id': 2, 'title': 'Two'}, 3]
+        for size in (1, 5, 1000):
+            self.assertEqual(list(iter_json(StringIO(json.dumps(rows)), size)), rows)
+            self.assertEqual(list(iter_json(StringIO('\n'.join(json.dumps(v) for v in rows)),
+                size)), rows)
+            self.assertEqual(list(iter_json(StringIO(' [ ]'), size)), [])
+            self.assertRaises(ValueError, list, iter_json(StringIO('[{"id": 1}'), size))
+
+    def test_write_json(self):
+        data = [{'id': 1, 'baz': {'id': 'a'}}, {'id': 2, 'baz': [{'id': 2.5}, {'id': 'a'}]}]
+        norm = Normalize()
+        norm.define_primary('foo')
+        norm.define_nested_entity('bar', 'baz')
+        res = norm.parse(copy.deepcopy(data))
+        for size in (1, 2, 1000):
+            out = StringIO()
+            write_json(res, out, size)
+            self.assertEqual(out.getvalue(), json.dumps(res))
+        norm.set_columnar()
+        out = StringIO()
+        write_json(norm.parse(copy.deepcopy(data)), out)
+        self.assertEqual(json.loads(out.getvalue()), json.loads(json.dumps(res)))
+        out = StringIO()
+        for chunk in norm.parse_iter(data, 1):
+            write_json(chunk, out)
+            out.write('\n')
+        self.assertEqual([json.loads(v)['results'] for v in out.getvalue().splitlines()],
+            [[1], [2]])
+
+    def test_normalize_stream(self):
+        norm = load_schema({'primary': 'foo', 'entities': [{'name': 'bar', 'key': 'baz'}]})
+        out = StringIO()
+        normalize_stream(norm, StringIO('{"id": 1, "baz": {"id": 1}}\n{"id": 2}'), out, 1)
+        self.assertEqual([json.loads(v) for v in out.getvalue().splitlines()], [{'entities':
+            {'foo': {'1': {'id': 1, 'baz': [1]}}, 'bar': {'1': {'id': 1}}}, 'results': [1]},
+            {'entities': {'foo': {'2': {'id': 2}}, 'bar': {}}, 'results': [2]}])
+
+        norm.add_one_to_many_key('foo_ids', 'baz', 'bar', 'foo')
+        out = StringIO()
+        normalize_stream(norm, StringIO('[{"id": 1, "baz": {"id": 1}}, {"id": 2}]'), out)
+        self.assertEqual(json.loads(out.getvalue()), {'entities': {'foo': {'1': {'id': 1, 'baz':
+            [1]}, '2': {'id': 2}}, 'bar': {'1': {'id': 1, 'foo_ids': [1]}}}, 'results': [1, 2]})
+
+        batch = load_schema({'primaries': [{'primary': 'foo', 'entities': [{'name': 'bar', 'key':
+            'baz'}]}, {'primary': 'asdf', 'entities': [{'name': 'bar', 'key': 'baz'}]}]})
+        out = StringIO()
+        normalize_stream(batch, StringIO('{"foo": [{"id": 1, "baz": {"id": 1}}], "asdf": [{"id": 2, '
+            '"baz": {"id": 1}}]}'), out)
+        self.assertEqual(json.loads(out.getvalue()), {'entities': {'foo': {'1': {'id': 1, 'baz':
+            [1]}}, 'asdf': {'2': {'id': 2, 'baz': [1]}}, 'bar': {'1': {'id': 1}}}, 'results':
+            {'foo': [1], 'asdf': [2]}})
+
+class FakePages(object):
+    '''an async iterator over pages, recording how many have been fetched'''
+
+    def __init__(self, pages):
+        self.pages = list(pages)
+        self.fetched = 0
+
+    def __aiter__(self):
+        return self
+
+    def __anext__(self):
+        if self.fetched == len(self.pages):
+            raise StopAsyncIteration
+        self.fetched += 1
+        return asyncio.sleep(0, result=self.pages[self.fetched - 1])
+
+@unittest.skipIf(parse_pages is None, 'asyncio is not available')
+class TestParsePages(unittest.TestCase):
+
+    def _run(self, coro):
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(coro)
+        finally:
+            loop.close()
+
+    def test_parse_pages(self):
+        pages = [[{'id': 1, 'baz': {'id': 1}}, {'id': 2, 'baz': {'id': 2}}], [], [{'id': 3,
+            'baz': [{'id': 1}, {'id': 3}]}]]
+        norm = Normalize()
+        norm.define_primary('foo')
+        norm.define_nested_entity('bar', 'baz')
+        norm.swap_primary('bar')
+        norm.add_one_to_many_key('foo_ids', 'id', 'bar', 'foo')
+        expected = norm.parse(copy.deepcopy([v for page in pages for v in page]))
+        self.assertEqual(self._run(parse_pages(norm, FakePages(copy.deepcopy(pages)))),
+            expected)
+        with ThreadPoolExecutor(1) as executor:
+            self.assertEqual(self._run(parse_pages(norm, FakePages(copy.deepcopy(pages)),
+                executor)), expected)
+        self.assertEqual(self._run(parse_pages(norm, FakePages([]))), None)
+
+    def test_prefetch(self):
+        source = FakePages([[{'id': 1}], [{'id': 2}], [{'id': 3}]])
+        norm = Normalize()
+        norm.define_primary('foo')
+        fetched = []
+        parse_entry = norm._parse_entry
+        norm._parse_entry = lambda *args: fetched.append(source.fetched) or parse_entry(*args)
+        self._run(parse_pages(norm, source))
+        self.assertEqual(fetched, [2, 3, 3])
+
+    def test_relations_stats(self):
+        norm = Normalize()
+        norm.define_primary('foo')
+        norm.define_nested_entity('bar', 'baz')
+        norm.set_relations()
+        norm.parse([{'id': 1, 'baz': {'id': 1}}])
+        relations = norm.relations
+        self._run(parse_pages(norm, FakePages([[{'id': 2, 'baz': {'id': 1}}]])))
+        self.assertEqual(relations.records('bar', 1), [1])
+        self.assertEqual(norm.relations.records('bar', 1), [2])
+        norm.set_stats()
+        self.assertRaises(ValueError, self._run, parse_pages(norm, FakePages([[{'id': 1}]])))
+
+
 if __name__ == '__main__':
     unittest.main()